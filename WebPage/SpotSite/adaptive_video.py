@@ -0,0 +1,199 @@
+"""
+Adapts the video sent to each client to how fast that client receives it
+
+Every frame is encoded once at each size of the rendition ladder (see "renditions" in config.json), and each
+socket picks the size and frame rate its own link can keep up with. A socket measures, once per evaluation period,
+how many of its frames were replaced before they could be sent, how much of the period it spent sending, and how
+many control messages are waiting. A client that falls behind steps down right away, and a client that keeps up
+steps back up after a few periods in a row.
+
+Classes:
+
+    Video_Rate_Control
+
+Misc Variables:
+
+    QUALITY_STEPS (tuple): the rendition level and frame rate of each quality step, best first
+"""
+import time
+
+# (rendition level, max frames per second per camera), best first. Level 0 is the full size frame,
+# None does not limit the frame rate
+QUALITY_STEPS = (
+    (0, None),
+    (1, None),
+    (1, 10),
+    (2, 10),
+    (2, 5),
+    (2, 2),
+)
+
+# How often the delivery of a socket is measured, in seconds
+EVALUATION_PERIOD = 1.0
+
+# How many good periods in a row a socket needs before its quality steps up
+STEP_UP_PERIODS = 3
+
+# A socket is behind when more than this share of its frames were replaced before they were sent...
+SKIPPED_SHARE_LIMIT = 0.25
+# ...or it spent more than this share of the period sending...
+BUSY_SHARE_LIMIT = 0.8
+# ...or this many control messages are waiting
+CONTROL_BACKLOG_LIMIT = 50
+
+# A socket keeps up when it spent less than this share of the period sending and skipped nothing
+IDLE_SHARE_LIMIT = 0.4
+
+# How much a new measurement moves the running averages
+STATS_SMOOTHING = 0.2
+
+
+class Video_Rate_Control:
+    """
+    Chooses the rendition and frame rate of the video sent to one socket
+
+    Attributes:
+        step (int): the current quality step, an index into QUALITY_STEPS
+        _last_frame_times (dict): when the last frame of each camera was accepted
+        _period_start (float): when the current evaluation period started
+        _accepted (int): frames accepted this period
+        _skipped (int): frames replaced before they were sent this period
+        _send_seconds (float): time spent sending frames this period
+        _sent_bytes (int): bytes of frames sent this period
+        _good_periods (int): how many periods in a row the socket kept up
+        _bytes_per_second (float): the running average rate frames are delivered at
+        _skipped_share (float): the share of frames skipped in the last period
+
+    Methods:
+        level:
+            The rendition level of the current quality step
+        max_fps:
+            The frame rate limit of the current quality step, None for no limit
+        accept(message, queued_control_messages):
+            Chooses the rendition of a video frame to send, or None to drop the frame
+        on_skipped():
+            Records that a frame was replaced before it was sent
+        on_sent(message, seconds):
+            Records that a frame was sent
+        get_stats():
+            Returns the quality step and delivery rate of the socket
+        _evaluate(now, queued_control_messages):
+            Steps the quality up or down at the end of each evaluation period
+    """
+
+    def __init__(self):
+        self.step = 0
+        self._last_frame_times = {}
+
+        self._period_start = time.monotonic()
+        self._accepted = 0
+        self._skipped = 0
+        self._send_seconds = 0.0
+        self._sent_bytes = 0
+        self._good_periods = 0
+
+        self._bytes_per_second = 0.0
+        self._skipped_share = 0.0
+
+    @property
+    def level(self) -> int:
+        """
+        The rendition level of the current quality step
+        """
+        return QUALITY_STEPS[self.step][0]
+
+    @property
+    def max_fps(self) -> float:
+        """
+        The frame rate limit of the current quality step, None for no limit
+        """
+        return QUALITY_STEPS[self.step][1]
+
+    def accept(self, message: object, queued_control_messages: int = 0) -> object:
+        """
+        Chooses the rendition of a video frame to send, or None to drop the frame
+
+        Args:
+            message (Outbound_Message): the video frame
+            queued_control_messages (int, optional): how many control messages the socket has waiting. Defaults to 0.
+
+        Returns:
+            Outbound_Message: the rendition to queue, None if the frame rate limit drops the frame
+        """
+        now = time.monotonic()
+        self._evaluate(now, queued_control_messages)
+
+        max_fps = self.max_fps
+        last_frame_time = self._last_frame_times.get(message.type)
+        if max_fps is not None and last_frame_time is not None and now - last_frame_time < 1 / max_fps:
+            return None
+        self._last_frame_times[message.type] = now
+        self._accepted += 1
+
+        return message.rendition(self.level)
+
+    def on_skipped(self) -> None:
+        """
+        Records that a frame was replaced before it was sent
+        """
+        self._skipped += 1
+
+    def on_sent(self, message: object, seconds: float) -> None:
+        """
+        Records that a frame was sent
+
+        Args:
+            message (Outbound_Message): the frame
+            seconds (float): how long sending the frame took
+        """
+        self._send_seconds += seconds
+        self._sent_bytes += len(message)
+
+    def get_stats(self) -> dict:
+        """
+        Returns the quality step and delivery rate of the socket
+
+        Returns:
+            dict: the stats
+        """
+        return {
+            "step": self.step,
+            "level": self.level,
+            "max_fps": self.max_fps,
+            "kilobytes_per_second": round(self._bytes_per_second / 1000, 1),
+            "skipped_share": round(self._skipped_share, 2),
+        }
+
+    def _evaluate(self, now: float, queued_control_messages: int) -> None:
+        """
+        Steps the quality up or down at the end of each evaluation period
+
+        Args:
+            now (float): the current monotonic time
+            queued_control_messages (int): how many control messages the socket has waiting
+        """
+        elapsed = now - self._period_start
+        if elapsed < EVALUATION_PERIOD:
+            return
+
+        self._skipped_share = self._skipped / self._accepted if self._accepted else 0.0
+        busy_share = self._send_seconds / elapsed
+        self._bytes_per_second += (self._sent_bytes / elapsed - self._bytes_per_second) * STATS_SMOOTHING
+
+        if self._skipped_share > SKIPPED_SHARE_LIMIT or busy_share > BUSY_SHARE_LIMIT \
+                or queued_control_messages > CONTROL_BACKLOG_LIMIT:
+            self.step = min(self.step + 1, len(QUALITY_STEPS) - 1)
+            self._good_periods = 0
+        elif self._skipped == 0 and busy_share < IDLE_SHARE_LIMIT:
+            self._good_periods += 1
+            if self._good_periods >= STEP_UP_PERIODS:
+                self.step = max(self.step - 1, 0)
+                self._good_periods = 0
+        else:
+            self._good_periods = 0
+
+        self._period_start = now
+        self._accepted = 0
+        self._skipped = 0
+        self._send_seconds = 0.0
+        self._sent_bytes = 0
@@ -7,8 +7,9 @@ import json
 from SpotSite import spot_control
 from SpotSite import secrets
 from SpotSite.spot_logging import log
-from SpotSite.utils import output_to_socket, print_exception, start_thread, read_json
+from SpotSite.utils import output_to_socket, publish_state, print_exception, start_thread, read_json, get_socket_stats
 from SpotSite.sql_stuff import SqliteConnection
+from SpotSite.command_queue import Command_Queue
 from SpotSite.spot_images.image_handler import Image_Handler
 from SpotSite.scratch_handling import scratch_handler
 
@@ -72,7 +73,7 @@ class Background_Process:
         self._is_accepting_commands = False
         self._will_immediately_run_commands = False
         self._should_run_commands = False
-        self.command_queue = []
+        self.command_queue = Command_Queue(self._send_command_queue_update)
         self._keys_up = []
         self._keys_down = []
 
@@ -387,7 +388,7 @@ class Background_Process:
             self._is_accepting_commands = False
             # Clear command queue so Spot does not execute commands the instant
             # the estop is released
-            self.command_queue = []
+            self.command_queue.clear()
             log("Estopped robot")
 
     def release_estop(self) -> None:
@@ -435,7 +436,7 @@ class Background_Process:
 
         self.keyboard_control_mode = "Walk"
 
-        self.command_queue = []
+        self.command_queue.clear()
         self.programs = {}
         self.keys = {}
         self._is_shutting_down = False
@@ -585,11 +586,10 @@ class Background_Process:
                 except:
                     print_exception(socket_index)
                 try:
-                    self.command_queue.pop(0)
+                    self.command_queue.pop()
                 except IndexError:
                     output_to_socket(socket_index, "Command List is empty!")
                 self._should_run_commands = False
-                self._update_command_queue()
 
             while self.command_queue and self._will_immediately_run_commands:
                 command = self.command_queue[0]
@@ -598,20 +598,33 @@ class Background_Process:
                 except:
                     print_exception(socket_index)
                 try:
-                    self.command_queue.pop(0)
+                    self.command_queue.pop()
                 except IndexError:
                     output_to_socket(socket_index, "Command List is empty!")
-                self._update_command_queue()
         self.is_running_commands = False
         self._should_run_commands = False
 
-    def _update_command_queue(self):
-        output_to_socket(-1, json.dumps(self.command_queue),
-                         all=True, type="command_queue")
+    def _send_command_queue_update(self, socket_index: any, update: dict) -> None:
+        """
+        Sends a change to the command queue, or the whole queue, to the client(s)
+
+        Args:
+            socket_index any: The index of the socket to output to, -1 for every socket
+            update (dict): The change or the whole queue, see SpotSite/command_queue.py
+        """
+        output_to_socket(socket_index, update, all=(socket_index == -1), type="command_queue")
+
+    def send_command_queue_snapshot(self, socket_index: any) -> None:
+        """
+        Sends the whole command queue to a client, ex. when it connects or its copy is out of date
+
+        Args:
+            socket_index any: The index of the socket to output to
+        """
+        self.command_queue.send_snapshot(socket_index)
 
     def add_command(self, data):
         self.command_queue.append(data)
-        self._update_command_queue()
 
     def _run_programs(self, socket_index: any) -> None:
         """
@@ -656,9 +669,8 @@ class Background_Process:
         power_state = state.power_state
         battery_percentage = power_state.locomotion_charge_percentage.value
         battery_runtime = power_state.locomotion_estimated_runtime.seconds
-        output_to_socket(-1, battery_percentage, all=True,
-                         type="battery_percentage")
-        output_to_socket(-1, battery_runtime, all=True, type="battery_runtime")
+        publish_state("battery_percentage", battery_percentage)
+        publish_state("battery_runtime", battery_runtime)
 
     def _do_command(self, command: object) -> None:
         """
@@ -808,8 +820,7 @@ class Background_Process:
             return
 
         self._do_keyboard_commands()
-        output_to_socket(-1, self.keyboard_control_mode,
-                         all=True, type="control_mode")
+        publish_state("control_mode", self.keyboard_control_mode)
 
     def start_bg_process(self, socket_index: any) -> None:
         """
@@ -904,13 +915,15 @@ class Background_Process:
             'is_running_commands': self.is_running_commands,
             'active_program_name': self.active_program_name,
             'program_socket_index': self.program_socket_index,
-            'command_queue': self.command_queue,
+            'command_queue': self.command_queue.snapshot(),
             'is_accepting_commands': self._is_accepting_commands,
             'will_auto_run_commands': self._will_immediately_run_commands,
             'should_run_commands': self._should_run_commands,
-            'command_queue': self.command_queue,
+            'command_queue': self.command_queue.snapshot(),
             'scratch_clients': scratch_handler.get_client_list(),
-            'scratch_controller': (scratch_handler.get_allowed_client_name(), scratch_handler.allowed_ip)
+            'scratch_controller': (scratch_handler.get_allowed_client_name(), scratch_handler.allowed_ip),
+            'video_stats': self.image_handler.get_video_stats(),
+            'socket_stats': get_socket_stats()
         }
 
     def get_server_state(self) -> dict:
@@ -0,0 +1,133 @@
+"""
+Holds the commands waiting to be run and tells the clients how the queue changes
+
+Instead of the whole queue, each change is sent as a delta with the version of the queue it leads to:
+
+    {"op": "append", "version": 12, "command": {...}}
+    {"op": "pop", "version": 13}
+    {"op": "clear", "version": 14}
+
+A socket that just connected, or whose version does not match a delta it receives, is sent the whole queue:
+
+    {"op": "snapshot", "version": 14, "commands": [...]}
+
+The matching client is the "command_queue" handler in static/js/main.js
+
+Classes:
+
+    Command_Queue
+"""
+import collections
+import threading
+
+
+class Command_Queue:
+    """
+    The commands waiting to be run, oldest first
+
+    Commands are added from the request and scratch threads and run from the background process thread, so every
+    change and the delta it sends happen under a lock. That keeps the deltas in the same order as the versions.
+
+    Attributes:
+        version (int): how many times the queue has changed
+        _commands (deque): the commands
+        _send (callable): sends an update to a socket, called with the socket index (-1 for every socket) and the
+            update
+        _lock (Lock): guards the commands and the version
+
+    Methods:
+        append(command):
+            Adds a command to the end of the queue
+        pop():
+            Removes and returns the first command of the queue
+        clear():
+            Removes every command from the queue
+        snapshot():
+            Returns a copy of the commands
+        send_snapshot(socket_index):
+            Sends the whole queue to a socket
+        _changed(update):
+            Moves to the next version and sends the change to every socket
+    """
+
+    def __init__(self, send: callable):
+        self.version = 0
+        self._commands = collections.deque()
+        self._send = send
+        self._lock = threading.Lock()
+
+    def append(self, command: dict) -> None:
+        """
+        Adds a command to the end of the queue
+
+        Args:
+            command (dict): the command
+        """
+        with self._lock:
+            self._commands.append(command)
+            self._changed({"op": "append", "command": command})
+
+    def pop(self) -> dict:
+        """
+        Removes and returns the first command of the queue
+
+        Raises:
+            IndexError: raised if the queue is empty
+
+        Returns:
+            dict: the command
+        """
+        with self._lock:
+            command = self._commands.popleft()
+            self._changed({"op": "pop"})
+            return command
+
+    def clear(self) -> None:
+        """
+        Removes every command from the queue
+        """
+        with self._lock:
+            if not self._commands:
+                return
+            self._commands.clear()
+            self._changed({"op": "clear"})
+
+    def snapshot(self) -> list:
+        """
+        Returns a copy of the commands
+
+        Returns:
+            list: the commands, oldest first
+        """
+        with self._lock:
+            return list(self._commands)
+
+    def send_snapshot(self, socket_index: any) -> None:
+        """
+        Sends the whole queue to a socket
+
+        Args:
+            socket_index (any): the index of the socket, -1 for every socket
+        """
+        with self._lock:
+            self._send(socket_index, {"op": "snapshot", "version": self.version, "commands": list(self._commands)})
+
+    def _changed(self, update: dict) -> None:
+        """
+        Moves to the next version and sends the change to every socket, must be called with the lock held
+
+        Args:
+            update (dict): the change, without its version
+        """
+        self.version += 1
+        update["version"] = self.version
+        self._send(-1, update)
+
+    def __len__(self) -> int:
+        return len(self._commands)
+
+    def __getitem__(self, index: int) -> dict:
+        return self._commands[index]
+
+    def __iter__(self):
+        return iter(self.snapshot())
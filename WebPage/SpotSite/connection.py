@@ -206,10 +206,10 @@ class WebSocket:
     async def send_text(self, text: str):
         await self.send({"type": SendEvent.SEND, "text": text})
 
-    async def send_bytes(self, text: t.Union[str, bytes]):
-        if isinstance(text, str):
-            text = text.encode()
-        await self.send({"type": SendEvent.SEND, "bytes": text})
+    async def send_bytes(self, data: t.Union[str, bytes]):
+        if isinstance(data, str):
+            data = data.encode()
+        await self.send({"type": SendEvent.SEND, "bytes": data})
 
     def _test_if_can_receive(self, message: t.Mapping):
         if message == "Disconnected":
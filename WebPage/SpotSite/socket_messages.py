@@ -0,0 +1,256 @@
+"""
+Encodes messages sent from the server to the client
+
+Messages are serialized once into an ```Outbound_Message``` and the same object is handed to every socket
+that should receive it, so the cost of encoding a message does not grow with the number of clients.
+
+Video frames are sent as binary websocket messages instead of base64 inside of json.
+Each frame is a fixed size header followed by the raw JPEG bytes:
+
+    kind (uint8) | camera id (uint8) | flags (uint16) | sequence (uint32) | receive timestamp (float64)
+
+All header fields are big-endian. The matching decoder is ```handle_binary_message``` in static/js/main.js
+
+The timestamp is when the server received the image, on the server's clock. It is not the robot's acquisition time,
+which is on the robot's clock.
+
+The flags describe how the client shows the image:
+
+    bits 0-1: quarter turns the image is rotated clockwise before it is shown
+    bit 2: the image is one tile of another camera's view, and the tile fields below are set
+    bits 4-5: the column of the tile, counted from the left
+    bits 6-7: the number of tiles in the view, minus one
+    bits 8-11: the camera id of the view the tile belongs to
+
+Large json messages, ex. the program list, are compressed for clients that said they can inflate them (see the
+"hello" action in websocket.py). A compressed message is a binary message holding the zlib compressed json:
+
+    kind (uint8) | zlib stream
+
+Each message is compressed at most once, the first time a socket sends it, and every other socket sends the same
+bytes. Video frames are never compressed, JPEG does not get any smaller.
+
+Classes:
+
+    Outbound_Message
+
+Functions:
+
+    encode_message(type, output) -> Outbound_Message
+    encode_video_frame(camera_name, image, sequence, timestamp) -> Outbound_Message
+    encode_video_renditions(camera_name, images, sequence, timestamp) -> Outbound_Message
+    pack_video_frame(camera_name, image, sequence, timestamp) -> bytes
+    video_frame_flags(quarter_turns, tile_of, tile, tiles) -> int
+
+Misc Variables:
+
+    FRAME_KIND_VIDEO (int): the first byte of every video frame
+    FRAME_KIND_DEFLATE (int): the first byte of every compressed json message
+    COMPRESSION_THRESHOLD (int): json messages shorter than this many characters are never compressed
+    COMPRESSION_LEVEL (int): the zlib level json messages are compressed at
+    VIDEO_FRAME_HEADER (Struct): the layout of the video frame header
+    VIDEO_FLAG_TILE (int): the flag set on images that are one tile of another camera's view
+    CAMERA_IDS (dict): maps camera names to the id sent in the frame header
+    CAMERA_NAMES (dict): maps the id sent in the frame header to the camera name
+"""
+import json
+import struct
+import zlib
+
+FRAME_KIND_VIDEO = 1
+FRAME_KIND_DEFLATE = 2
+
+# Below this size the time spent compressing and inflating is worth more than the bytes saved
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+
+VIDEO_FRAME_HEADER = struct.Struct("!BBHId")
+
+VIDEO_FLAG_ROTATION_MASK = 0x3
+VIDEO_FLAG_TILE = 0x4
+VIDEO_FLAG_TILE_SHIFT = 4
+VIDEO_FLAG_TILES_SHIFT = 6
+VIDEO_FLAG_TILE_OF_SHIFT = 8
+
+# The order must match CAMERA_NAMES in static/js/main.js
+CAMERA_IDS = {
+    "front": 0,
+    "back": 1,
+    "left": 2,
+    "right": 3,
+    "frontleft": 4,
+    "frontright": 5,
+}
+CAMERA_NAMES = {id: name for name, id in CAMERA_IDS.items()}
+
+
+class Outbound_Message:
+    """
+    A message that has already been serialized and can be sent to any number of sockets
+
+    Attributes:
+        type(str): the type of the message
+        data(str, bytes): the serialized message. str is sent as a text message, bytes as a binary message
+        renditions(dict): the same video frame at each rendition level, None if the frame has a single size
+        _compressed(bytes): the compressed message, b"" if compressing does not make it smaller, None until the
+            message is first compressed
+    """
+    __slots__ = ("type", "data", "renditions", "_compressed")
+
+    def __init__(self, type: str, data: any, renditions: dict = None):
+        self.type = type
+        self.data = data
+        self.renditions = renditions
+        self._compressed = None
+
+    @property
+    def is_binary(self) -> bool:
+        """
+        Whether the message is sent as a binary message
+        """
+        return isinstance(self.data, bytes)
+
+    @property
+    def is_video(self) -> bool:
+        """
+        Whether the message is a video frame. Only the newest video frame for each camera needs to be delivered
+        """
+        return self.type.startswith("@")
+
+    @property
+    def video_view(self) -> str:
+        """
+        The camera whose view a video frame is shown in: its own camera, or the camera it is a tile of
+        """
+        camera_id, flags = self.data[1], int.from_bytes(self.data[2:4], "big")
+        if flags & VIDEO_FLAG_TILE:
+            camera_id = (flags >> VIDEO_FLAG_TILE_OF_SHIFT) & 0xF
+        return CAMERA_NAMES[camera_id]
+
+    def compressed(self) -> bytes:
+        """
+        Returns the message compressed as a binary message, compressing it the first time it is asked for
+
+        Returns:
+            bytes: the compressed message, None if the message is not compressed (binary, too short, or no smaller
+                once compressed)
+        """
+        if self.is_binary or len(self.data) < COMPRESSION_THRESHOLD:
+            return None
+        if self._compressed is None:
+            compressed = bytes((FRAME_KIND_DEFLATE,)) + zlib.compress(self.data.encode(), COMPRESSION_LEVEL)
+            self._compressed = compressed if len(compressed) < len(self.data) else b""
+        return self._compressed or None
+
+    def rendition(self, level: int) -> "Outbound_Message":
+        """
+        Returns the rendition of a video frame at a level, or the closest level that was encoded
+
+        Smaller renditions (higher levels) are preferred over larger ones when the level was not encoded
+
+        Args:
+            level (int): the rendition level, 0 is the full size frame
+
+        Returns:
+            Outbound_Message: the rendition
+        """
+        if not self.renditions:
+            return self
+        if level in self.renditions:
+            return self.renditions[level]
+        smaller = [available for available in self.renditions if available > level]
+        closest = min(smaller) if smaller else max(self.renditions)
+        return self.renditions[closest]
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+def encode_message(type: str, output: any) -> Outbound_Message:
+    """
+    Serializes a json message in the format the client expects
+
+    Args:
+        type (str): the type of the message
+        output (any): the content of the message, must be json serializable
+
+    Returns:
+        Outbound_Message: the serialized message
+    """
+    return Outbound_Message(type, json.dumps({
+        "type": type,
+        "output": output
+    }))
+
+
+def encode_video_frame(camera_name: str, image: bytes, sequence: int, timestamp: float, flags: int = 0) -> Outbound_Message:
+    """
+    Serializes a JPEG image as a binary video frame
+
+    see ```pack_video_frame``` for argument information
+
+    Returns:
+        Outbound_Message: the serialized frame, with the type "@" + camera_name
+    """
+    return Outbound_Message("@" + camera_name, pack_video_frame(camera_name, image, sequence, timestamp, flags))
+
+
+def encode_video_renditions(camera_name: str, images: dict, sequence: int, timestamp: float,
+                            flags: int = 0) -> Outbound_Message:
+    """
+    Serializes every rendition of a video frame, so each socket can pick the one its link can keep up with
+
+    Args:
+        images (dict): the JPEG encoded image at each rendition level
+
+    see ```pack_video_frame``` for other argument information
+
+    Returns:
+        Outbound_Message: the largest rendition, holding every rendition
+    """
+    renditions = {level: encode_video_frame(camera_name, image, sequence, timestamp, flags)
+                  for level, image in images.items()}
+    largest = renditions[min(renditions)]
+    return Outbound_Message(largest.type, largest.data, renditions)
+
+
+def pack_video_frame(camera_name: str, image: bytes, sequence: int, timestamp: float, flags: int = 0) -> bytes:
+    """
+    Packs a JPEG image and its header into a single binary frame
+
+    Args:
+        camera_name (str): the name of the camera the image came from (see CAMERA_IDS)
+        image (bytes): the JPEG encoded image
+        sequence (int): the sequence number of the image for the camera, wraps at 2^32
+        timestamp (float): the time the server received the image from the robot, in seconds since the epoch
+        flags (int, optional): extra information about the image. Defaults to 0.
+
+    Returns:
+        bytes: the frame
+    """
+    header = VIDEO_FRAME_HEADER.pack(FRAME_KIND_VIDEO, CAMERA_IDS[camera_name], flags,
+                                     sequence & 0xFFFFFFFF, timestamp)
+    return b"".join((header, image))
+
+
+def video_frame_flags(quarter_turns: int = 0, tile_of: str = None, tile: int = 0, tiles: int = 1) -> int:
+    """
+    Creates the flags of a video frame
+
+    Args:
+        quarter_turns (int, optional): quarter turns the client rotates the image clockwise. Defaults to 0.
+        tile_of (str, optional): the camera whose view the image is a tile of, None if the image is shown on its
+            own. Defaults to None.
+        tile (int, optional): the column of the tile, from 0 to 3. Defaults to 0.
+        tiles (int, optional): the number of tiles in the view, from 1 to 4. Defaults to 1.
+
+    Returns:
+        int: the flags
+    """
+    flags = quarter_turns & VIDEO_FLAG_ROTATION_MASK
+    if tile_of is not None:
+        flags |= VIDEO_FLAG_TILE
+        flags |= (tile & 0x3) << VIDEO_FLAG_TILE_SHIFT
+        flags |= ((tiles - 1) & 0x3) << VIDEO_FLAG_TILES_SHIFT
+        flags |= (CAMERA_IDS[tile_of] & 0xF) << VIDEO_FLAG_TILE_OF_SHIFT
+    return flags
@@ -0,0 +1,186 @@
+"""
+Fetches images from Spot's cameras
+
+Classes:
+
+    Camera_Fetcher
+
+Functions:
+
+    wrap_sdk_future(sdk_future, loop) -> Future
+"""
+import asyncio
+import time
+
+# How much a new timing moves the running average
+TIMING_SMOOTHING = 0.2
+
+
+def wrap_sdk_future(sdk_future: object, loop: asyncio.AbstractEventLoop) -> asyncio.Future:
+    """
+    Wraps the future returned by an ```_async``` method of the Spot SDK so it can be awaited
+
+    The SDK completes its futures on a gRPC thread, so the result is handed to the event loop thread-safely
+
+    Args:
+        sdk_future (object): the future returned by the SDK
+        loop (AbstractEventLoop): the event loop the future is awaited on
+
+    Returns:
+        Future: the awaitable future
+    """
+    future = loop.create_future()
+
+    def settle(result: any, error: Exception) -> None:
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def transfer(done: object) -> None:
+        try:
+            result, error = done.result(), None
+        except Exception as e:
+            result, error = None, e
+        loop.call_soon_threadsafe(settle, result, error)
+
+    sdk_future.add_done_callback(transfer)
+    return future
+
+
+class Camera_Fetcher:
+    """
+    Fetches images from any number of image sources in a single round trip, without blocking the event loop
+
+    In "batched" mode every source is requested in one ```get_image_from_sources_async``` call, so all sources
+    share the time of that call. In "parallel" mode each source is requested with its own call, all at the same
+    time, and timed separately.
+
+    Attributes:
+        _image_client (ImageClient): the client used to request images
+        _mode (str): "batched" or "parallel"
+        _timings (dict): the last and average fetch time, in milliseconds, for each source
+
+    Methods:
+        fetch(sources):
+            Fetches the newest image from each source
+        _fetch_batched(sources):
+            Fetches every source with a single request
+        _fetch_parallel(sources):
+            Fetches every source with its own request, all at the same time
+        _fetch_one(source):
+            Fetches and times a single source
+        _request(sources):
+            Requests images from the robot and waits for them on the event loop
+        _record_timing(source, milliseconds):
+            Updates the timings of a source
+        get_timings():
+            Returns the fetch timings of each source
+    """
+
+    def __init__(self, image_client: object, mode: str = "batched"):
+        self._image_client = image_client
+        self._mode = mode
+        self._timings = {}
+
+    async def fetch(self, sources: list) -> dict:
+        """
+        Fetches the newest image from each source
+
+        Args:
+            sources (list): the names of the image sources, ex. "back_fisheye_image"
+
+        Returns:
+            dict: the image response for each source, by source name
+        """
+        if not sources:
+            return {}
+        if self._mode == "parallel":
+            return await self._fetch_parallel(sources)
+        return await self._fetch_batched(sources)
+
+    async def _fetch_batched(self, sources: list) -> dict:
+        """
+        Fetches every source with a single request
+
+        Args:
+            sources (list): the names of the image sources
+
+        Returns:
+            dict: the image response for each source, by source name
+        """
+        start = time.perf_counter()
+        responses = await self._request(sources)
+        milliseconds = (time.perf_counter() - start) * 1000
+
+        for source in sources:
+            self._record_timing(source, milliseconds)
+        return {response.source.name: response for response in responses}
+
+    async def _fetch_parallel(self, sources: list) -> dict:
+        """
+        Fetches every source with its own request, all at the same time
+
+        Args:
+            sources (list): the names of the image sources
+
+        Returns:
+            dict: the image response for each source, by source name
+        """
+        responses = await asyncio.gather(*(self._fetch_one(source) for source in sources))
+        return dict(zip(sources, responses))
+
+    async def _fetch_one(self, source: str) -> object:
+        """
+        Fetches and times a single source
+
+        Args:
+            source (str): the name of the image source
+
+        Returns:
+            object: the image response
+        """
+        start = time.perf_counter()
+        response = (await self._request([source]))[0]
+        self._record_timing(source, (time.perf_counter() - start) * 1000)
+        return response
+
+    async def _request(self, sources: list) -> list:
+        """
+        Requests images from the robot and waits for them on the event loop
+
+        Args:
+            sources (list): the names of the image sources
+
+        Returns:
+            list: the image responses
+        """
+        loop = asyncio.get_running_loop()
+        return await wrap_sdk_future(self._image_client.get_image_from_sources_async(list(sources)), loop)
+
+    def _record_timing(self, source: str, milliseconds: float) -> None:
+        """
+        Updates the timings of a source
+
+        Args:
+            source (str): the name of the image source
+            milliseconds (float): how long the fetch took
+        """
+        timing = self._timings.get(source)
+        if timing is None:
+            self._timings[source] = {"last_ms": milliseconds, "average_ms": milliseconds}
+            return
+        timing["last_ms"] = milliseconds
+        timing["average_ms"] += (milliseconds - timing["average_ms"]) * TIMING_SMOOTHING
+
+    def get_timings(self) -> dict:
+        """
+        Returns the fetch timings of each source
+
+        Returns:
+            dict: the last and average fetch time, in milliseconds, for each source
+        """
+        return {source: {name: round(value, 2) for name, value in timing.items()}
+                for source, timing in list(self._timings.items())}
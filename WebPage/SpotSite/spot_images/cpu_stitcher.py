@@ -0,0 +1,249 @@
+"""
+Stitches the front fisheye images on the CPU, without OpenGL
+
+The images are projected onto the same virtual plane as ```stitch_images.draw_routine```, and blended with the same
+weights as shader_frag.glsl. Everything is computed in the body frame, where the position of the robot cancels out,
+so the pixel each output pixel is read from only depends on the camera extrinsics and intrinsics. That lookup table
+is built once and reused until the camera geometry changes, and each frame is then a vectorized NumPy gather.
+
+Classes:
+
+    Cpu_Stitcher
+"""
+import math
+import time
+
+import numpy
+from PIL import Image
+
+from SpotSite.spot_images.stitch_geometry import (ImagePreppedForOpenGL, Prepared_Image_Cache,
+                                                  RECT_STITCHING_DISTANCE_METERS, FIELD_OF_VIEW, look_at_matrix,
+                                                  virtual_camera)
+
+# The same blending constants as shader_frag.glsl
+BLENDING_MINIMUM = 0.001
+BLENDING_POWER = 10.0
+
+# Colors of the regions no image covers. The plane is drawn in the shader's backColor (unset, so black),
+# anything off the plane is the clear color (white)
+PLANE_COLOR = 0
+CLEAR_COLOR = 255
+
+
+class Cpu_Stitcher:
+    """
+    Stitches the right and left front fisheye images with precomputed remap tables
+
+    Attributes:
+        _width (int): width of the stitched image
+        _height (int): height of the stitched image
+        _remap_key (bytes): the camera geometry the remap tables were built for
+        _remap (dict): the remap tables
+        _prepared_images (Prepared_Image_Cache): the decoded images and camera matrices
+        _build_ms (float): how long the remap tables took to build, in milliseconds
+        _average_ms (float): the running average time to stitch one frame, in milliseconds
+
+    Methods:
+        start_render_loop():
+            Does nothing, the CPU stitcher has no render loop
+        stop():
+            Does nothing, the CPU stitcher has no render loop
+        stitch(image_1, image_2):
+            Stitches the two images
+        get_stats():
+            Returns how long the stitcher takes
+        _geometry_key(image_1, image_2):
+            Returns a key that changes whenever the camera geometry changes
+        _build_remap(image_1, image_2):
+            Builds the remap tables for the camera geometry
+        _camera_remap(image, points, hits):
+            Builds the remap table for one camera
+        _apply_remap(image_1, image_2):
+            Stitches two decoded images with the remap tables
+    """
+
+    def __init__(self, width: int = 1080, height: int = 720):
+        self._width = width
+        self._height = height
+
+        self._remap_key = None
+        self._remap = None
+        self._prepared_images = Prepared_Image_Cache()
+
+        self._build_ms = 0.0
+        self._average_ms = 0.0
+
+    def start_render_loop(self) -> None:
+        """
+        Does nothing, the CPU stitcher has no render loop
+        """
+
+    def stop(self) -> None:
+        """
+        Does nothing, the CPU stitcher has no render loop
+        """
+
+    def stitch(self, image_1: object, image_2: object) -> Image:
+        """
+        Stitches the two images
+
+        Args:
+            image_1 (bosdyn.client.image): the image from the right camera
+            image_2 (bosdyn.client.image): the image from the left camera
+
+        Returns:
+            Image: the stitched image
+        """
+        start = time.perf_counter()
+        image_1 = self._prepared_images.get(image_1)
+        image_2 = self._prepared_images.get(image_2)
+
+        key = self._geometry_key(image_1, image_2)
+        if key != self._remap_key:
+            build_start = time.perf_counter()
+            self._remap = self._build_remap(image_1, image_2)
+            self._remap_key = key
+            self._build_ms = (time.perf_counter() - build_start) * 1000
+
+        stitched = Image.fromarray(self._apply_remap(image_1.image, image_2.image))
+        self._average_ms += ((time.perf_counter() - start) * 1000 - self._average_ms) * 0.2
+        return stitched
+
+    def get_stats(self) -> dict:
+        """
+        Returns how long the stitcher takes
+
+        Returns:
+            dict: the time to build the remap tables and the average time to stitch a frame, in milliseconds
+        """
+        return {
+            "stitcher": "cpu",
+            "remap_build_ms": round(self._build_ms, 2),
+            "average_ms": round(self._average_ms, 2),
+        }
+
+    def _geometry_key(self, image_1: ImagePreppedForOpenGL, image_2: ImagePreppedForOpenGL) -> bytes:
+        """
+        Returns a key that changes whenever the camera geometry changes
+
+        Args:
+            image_1 (ImagePreppedForOpenGL): the image from the right camera
+            image_2 (ImagePreppedForOpenGL): the image from the left camera
+
+        Returns:
+            bytes: the key
+        """
+        parts = []
+        for image in (image_1, image_2):
+            parts.append(numpy.round(image.body_T_image_sensor.to_matrix(), 6).tobytes())
+            parts.append(numpy.round(image.camera_projection_mat, 6).tobytes())
+            parts.append(str(image.image.shape).encode())
+        return b"|".join(parts)
+
+    def _build_remap(self, image_1: ImagePreppedForOpenGL, image_2: ImagePreppedForOpenGL) -> dict:
+        """
+        Builds the remap tables for the camera geometry
+
+        A ray is cast from the virtual camera through every output pixel onto the stitching plane, and the point
+        it hits is projected into both cameras
+
+        Args:
+            image_1 (ImagePreppedForOpenGL): the image from the right camera
+            image_2 (ImagePreppedForOpenGL): the image from the left camera
+
+        Returns:
+            dict: the flat source pixel index and blending weight of each output pixel for both cameras, and the
+                color of pixels neither camera covers
+        """
+        eye, eye_norm = virtual_camera(image_1, image_2)
+        plane = eye + eye_norm * RECT_STITCHING_DISTANCE_METERS
+        view = look_at_matrix(eye, plane, numpy.array([0, 0, 1]))
+        side, up, forward = view[0, :3], view[1, :3], -view[2, :3]
+
+        # Pixel centers, with the first row at the top of the image
+        tan_half_fov = math.tan(math.radians(FIELD_OF_VIEW) / 2)
+        aspect = self._width / self._height
+        x = ((numpy.arange(self._width) + 0.5) / self._width * 2 - 1) * tan_half_fov * aspect
+        y = (1 - (numpy.arange(self._height) + 0.5) / self._height * 2) * tan_half_fov
+        directions = x[None, :, None] * side + y[:, None, None] * up + forward
+
+        # Intersect every ray with the plane
+        facing = directions.dot(eye_norm)
+        hits = facing > 1e-9
+        distance = numpy.where(hits, RECT_STITCHING_DISTANCE_METERS / numpy.where(hits, facing, 1), 0)
+        points = eye + directions * distance[..., None]
+
+        index_1, weight_1 = self._camera_remap(image_1, points, hits)
+        index_2, weight_2 = self._camera_remap(image_2, points, hits)
+
+        total = weight_1 + weight_2
+        covered = total > 0
+        safe_total = numpy.where(covered, total, 1)
+        background = numpy.where(hits, PLANE_COLOR, CLEAR_COLOR)
+
+        return {
+            "index_1": index_1.ravel(),
+            "index_2": index_2.ravel(),
+            "weight_1": (weight_1 / safe_total).astype(numpy.float32).ravel(),
+            "weight_2": (weight_2 / safe_total).astype(numpy.float32).ravel(),
+            "background": numpy.where(covered, 0, background).astype(numpy.float32).ravel(),
+        }
+
+    def _camera_remap(self, image: ImagePreppedForOpenGL, points: numpy.ndarray, hits: numpy.ndarray) -> tuple:
+        """
+        Builds the remap table for one camera
+
+        Args:
+            image (ImagePreppedForOpenGL): the camera image
+            points (numpy.ndarray): the point on the plane seen by each output pixel, in the body frame
+            hits (numpy.ndarray): whether the ray of each output pixel hit the plane
+
+        Returns:
+            tuple: the flat index of the source pixel and the unnormalized blending weight of each output pixel
+        """
+        # camera_projection_mat * sensor_T_body, equal to the shader's MVP * vision_T_body
+        camera = image.camera_projection_mat.dot(image.body_T_image_sensor.inverse().to_matrix())
+        projected = points.dot(camera[:3, :3].T) + camera[:3, 3]
+
+        depth = projected[..., 2]
+        in_front = hits & (depth > 0)
+        safe_depth = numpy.where(in_front, depth, 1)
+        u = projected[..., 0] / safe_depth
+        v = projected[..., 1] / safe_depth
+
+        # calculateScore from shader_frag.glsl
+        score_u = 1 - numpy.abs(u * 2 - 1)
+        score_v = 1 - numpy.abs(v * 2 - 1)
+        inside = in_front & (score_u >= 0) & (score_v >= 0)
+        score = score_u * score_v * (1 - BLENDING_MINIMUM) + BLENDING_MINIMUM
+        weight = numpy.where(inside, numpy.power(numpy.where(inside, score, 0), BLENDING_POWER), 0)
+
+        rows, cols = image.image.shape[:2]
+        column = numpy.clip((u * cols).astype(numpy.int64), 0, cols - 1)
+        row = numpy.clip((v * rows).astype(numpy.int64), 0, rows - 1)
+        return (row * cols + column).astype(numpy.int32), weight
+
+    def _apply_remap(self, image_1: numpy.ndarray, image_2: numpy.ndarray) -> numpy.ndarray:
+        """
+        Stitches two decoded images with the remap tables
+
+        Args:
+            image_1 (numpy.ndarray): the decoded image from the right camera
+            image_2 (numpy.ndarray): the decoded image from the left camera
+
+        Returns:
+            numpy.ndarray: the stitched image
+        """
+        remap = self._remap
+        channels = 1 if image_1.ndim == 2 else image_1.shape[2]
+        pixels_1 = image_1.reshape(-1, channels)
+        pixels_2 = image_2.reshape(-1, channels)
+
+        stitched = pixels_1[remap["index_1"]] * remap["weight_1"][:, None]
+        stitched += pixels_2[remap["index_2"]] * remap["weight_2"][:, None]
+        stitched += remap["background"][:, None]
+
+        stitched = stitched.astype(numpy.uint8)
+        if channels == 1:
+            return stitched.reshape(self._height, self._width)
+        return stitched.reshape(self._height, self._width, channels)
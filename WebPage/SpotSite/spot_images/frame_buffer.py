@@ -0,0 +1,157 @@
+"""
+Holds the newest encoded frame of each camera for consumers other than the websockets
+
+Each camera keeps only its newest frame, with its sequence number and the time it was received. The send stage of
+the video loop publishes every frame it sends, and readers wait for the next one without polling. A reader that fell
+behind skips straight to the newest frame. Frames are immutable once published, so every reader shares the same JPEG
+bytes without copying them. Readers register the camera they read, so the video loop keeps fetching a camera while
+someone reads it.
+
+Classes:
+
+    Frame
+    Frame_Buffer
+"""
+import asyncio
+import contextlib
+import threading
+
+
+class Frame:
+    """
+    An encoded frame from a camera
+
+    Attributes:
+        camera_name (str): the name of the camera
+        sequence (int): the sequence number of the frame for the camera
+        timestamp (float): the time the server received the frame from the robot, in seconds since the epoch
+        data (bytes): the JPEG bytes
+    """
+    __slots__ = ("camera_name", "sequence", "timestamp", "data")
+
+    def __init__(self, camera_name: str, sequence: int, timestamp: float, data: bytes):
+        self.camera_name = camera_name
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.data = data
+
+
+class Frame_Buffer:
+    """
+    The newest frame of each camera, shared by every reader
+
+    Attributes:
+        _frames (dict): the newest frame of each camera
+        _waiters (dict): the futures of the readers waiting for the next frame of each camera
+        _readers (dict): how many readers each camera has
+        _lock (Lock): guards the frames, waiters and readers, so frames can be published and read from any thread,
+            not only the event loop the video loop runs on
+
+    Methods:
+        publish(camera_name, data, sequence, timestamp):
+            Stores the newest frame of a camera, replacing the last one, and wakes up its waiting readers
+        wait_for_frame(camera_name, after_sequence, timeout):
+            Waits for a frame newer than after_sequence
+        reader(camera_name):
+            Registers a reader of a camera for as long as the context is open
+        active_cameras():
+            Returns the cameras with at least one reader
+        _wake(future, frame):
+            Hands a frame to a waiting reader, on the reader's event loop
+    """
+
+    def __init__(self):
+        self._frames = {}
+        self._waiters = {}
+        self._readers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, camera_name: str, data: bytes, sequence: int, timestamp: float) -> None:
+        """
+        Stores the newest frame of a camera, replacing the last one, and wakes up its waiting readers
+
+        Safe to call from any thread
+
+        Args:
+            camera_name (str): the name of the camera
+            data (bytes): the JPEG bytes
+            sequence (int): the sequence number of the frame for the camera
+            timestamp (float): the time the server received the frame from the robot, in seconds since the epoch
+        """
+        frame = Frame(camera_name, sequence, timestamp, data)
+        with self._lock:
+            self._frames[camera_name] = frame
+            waiters = self._waiters.pop(camera_name, [])
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self._wake, future, frame)
+
+    async def wait_for_frame(self, camera_name: str, after_sequence: int = None, timeout: float = None) -> Frame:
+        """
+        Waits for a frame newer than after_sequence
+
+        Args:
+            camera_name (str): the name of the camera
+            after_sequence (int, optional): the sequence number of the last frame the reader has, None to return the
+                newest frame right away if there is one. Defaults to None.
+            timeout (float, optional): how long to wait, in seconds, None to wait forever. Defaults to None.
+
+        Returns:
+            Frame: the frame, None if no new frame arrived in time
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            frame = self._frames.get(camera_name)
+            if frame is not None and frame.sequence != after_sequence:
+                return frame
+            future = loop.create_future()
+            self._waiters.setdefault(camera_name, []).append((loop, future))
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                waiters = self._waiters.get(camera_name, [])
+                if (loop, future) in waiters:
+                    waiters.remove((loop, future))
+            return None
+
+    @contextlib.contextmanager
+    def reader(self, camera_name: str):
+        """
+        Registers a reader of a camera for as long as the context is open
+
+        Args:
+            camera_name (str): the name of the camera
+        """
+        with self._lock:
+            self._readers[camera_name] = self._readers.get(camera_name, 0) + 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._readers[camera_name] -= 1
+                if not self._readers[camera_name]:
+                    del self._readers[camera_name]
+
+    def active_cameras(self) -> set:
+        """
+        Returns the cameras with at least one reader
+
+        Returns:
+            set: the names of the cameras
+        """
+        with self._lock:
+            return set(self._readers)
+
+    @staticmethod
+    def _wake(future: asyncio.Future, frame: Frame) -> None:
+        """
+        Hands a frame to a waiting reader, on the reader's event loop
+
+        Args:
+            future (Future): the future the reader is waiting on
+            frame (Frame): the frame
+        """
+        if not future.done():
+            future.set_result(frame)
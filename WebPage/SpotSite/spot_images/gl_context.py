@@ -0,0 +1,239 @@
+"""
+Creates the OpenGL context used to stitch images
+
+The stitcher always renders into a framebuffer object, so the context never has to be shown on screen.
+Three backends can provide the context:
+
+    glfw: a hidden glfw window, needs a display
+    egl: an EGL pbuffer, works on headless Linux with a GPU driver (or Mesa)
+    osmesa: Mesa's software renderer, works anywhere Mesa is installed
+
+PyOpenGL picks its platform when OpenGL.GL is first imported, so the backend is selected when this module is
+imported and this module must be imported before OpenGL.GL.
+
+Classes:
+
+    Glfw_Context
+    Egl_Context
+    Osmesa_Context
+
+Functions:
+
+    select_backend(requested) -> str
+    create_context(width, height) -> object
+
+Misc Variables:
+
+    BACKEND (str): the backend selected at startup
+"""
+import ctypes
+import os
+import sys
+
+from SpotSite.spot_logging import log
+from SpotSite.utils import read_json
+
+BACKENDS = ("glfw", "egl", "osmesa")
+
+
+def select_backend(requested: str = "auto") -> str:
+    """
+    Selects the backend used to create the OpenGL context
+
+    "auto" uses egl on Linux when there is no display, and glfw everywhere else.
+    A PYOPENGL_PLATFORM environment variable of "egl" or "osmesa" always wins over "auto"
+
+    Args:
+        requested (str, optional): "auto" or one of BACKENDS. Defaults to "auto".
+
+    Returns:
+        str: the selected backend
+    """
+    if requested not in BACKENDS:
+        platform = os.environ.get("PYOPENGL_PLATFORM", "")
+        if platform in ("egl", "osmesa"):
+            requested = platform
+        elif sys.platform.startswith("linux") and not os.environ.get("DISPLAY") \
+                and not os.environ.get("WAYLAND_DISPLAY"):
+            requested = "egl"
+        else:
+            requested = "glfw"
+
+    if requested in ("egl", "osmesa"):
+        if "OpenGL.GL" in sys.modules and os.environ.get("PYOPENGL_PLATFORM") != requested:
+            log(f"OpenGL was imported before the {requested} backend was selected, stitching may not work")
+        os.environ["PYOPENGL_PLATFORM"] = requested
+    return requested
+
+
+BACKEND = select_backend(read_json("SpotSite/config.json").get("video", {}).get("stitch_backend", "auto"))
+
+
+class Glfw_Context:
+    """
+    An OpenGL context owned by a hidden glfw window
+
+    Methods:
+        should_close():
+            Returns whether the window was closed
+        destroy():
+            Destroys the window and the context
+    """
+
+    def __init__(self, width: int, height: int):
+        import glfw
+        self._glfw = glfw
+
+        if not glfw.init():
+            raise Exception("Unable to initialize glfw")
+        glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+        self._window = glfw.create_window(width, height, "Image Stitching", None, None)
+        if not self._window:
+            glfw.terminate()
+            raise Exception("No OpenGL Window")
+
+        glfw.make_context_current(self._window)
+
+    def should_close(self) -> bool:
+        """
+        Returns whether the window was closed
+
+        Returns:
+            bool: whether the window was closed
+        """
+        self._glfw.poll_events()
+        return self._glfw.window_should_close(self._window)
+
+    def destroy(self) -> None:
+        """
+        Destroys the window and the context
+        """
+        self._glfw.terminate()
+
+
+class Egl_Context:
+    """
+    An OpenGL context with an EGL pbuffer surface, which does not need a display
+
+    Methods:
+        should_close():
+            Always False, there is no window to close
+        destroy():
+            Destroys the surface and the context
+    """
+
+    def __init__(self, width: int, height: int):
+        from OpenGL import EGL
+        from OpenGL import arrays
+        self._egl = EGL
+
+        self._display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = ctypes.c_long(), ctypes.c_long()
+        if not EGL.eglInitialize(self._display, major, minor):
+            raise Exception("Unable to initialize EGL")
+
+        config_attributes = arrays.GLintArray.asArray([
+            EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+            EGL.EGL_RED_SIZE, 8,
+            EGL.EGL_GREEN_SIZE, 8,
+            EGL.EGL_BLUE_SIZE, 8,
+            EGL.EGL_ALPHA_SIZE, 8,
+            EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+            EGL.EGL_NONE
+        ])
+        configs = (EGL.EGLConfig * 1)()
+        num_configs = ctypes.c_long()
+        EGL.eglChooseConfig(self._display, config_attributes, configs, 1, num_configs)
+        if num_configs.value < 1:
+            raise Exception("No EGL config supports desktop OpenGL with a pbuffer")
+
+        pbuffer_attributes = arrays.GLintArray.asArray([
+            EGL.EGL_WIDTH, width,
+            EGL.EGL_HEIGHT, height,
+            EGL.EGL_NONE
+        ])
+        self._surface = EGL.eglCreatePbufferSurface(self._display, configs[0], pbuffer_attributes)
+
+        # The shaders use the compatibility profile, which is what desktop OpenGL contexts default to
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self._context = EGL.eglCreateContext(self._display, configs[0], EGL.EGL_NO_CONTEXT, None)
+        if not self._context:
+            raise Exception("Unable to create an EGL context")
+
+        if not EGL.eglMakeCurrent(self._display, self._surface, self._surface, self._context):
+            raise Exception("Unable to make the EGL context current")
+
+    def should_close(self) -> bool:
+        """
+        Always False, there is no window to close
+        """
+        return False
+
+    def destroy(self) -> None:
+        """
+        Destroys the surface and the context
+        """
+        EGL = self._egl
+        EGL.eglMakeCurrent(self._display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroySurface(self._display, self._surface)
+        EGL.eglDestroyContext(self._display, self._context)
+        EGL.eglTerminate(self._display)
+
+
+class Osmesa_Context:
+    """
+    An OpenGL context rendered in software by OSMesa, which needs neither a display nor a GPU
+
+    Methods:
+        should_close():
+            Always False, there is no window to close
+        destroy():
+            Destroys the context
+    """
+
+    def __init__(self, width: int, height: int):
+        from OpenGL import osmesa
+        from OpenGL import arrays
+        from OpenGL.GL import GL_UNSIGNED_BYTE
+        self._osmesa = osmesa
+
+        self._context = osmesa.OSMesaCreateContextExt(osmesa.OSMESA_RGBA, 24, 0, 0, None)
+        if not self._context:
+            raise Exception("Unable to create an OSMesa context")
+
+        # OSMesa needs a buffer to draw to even though the stitcher draws into its own framebuffer
+        self._buffer = arrays.GLubyteArray.zeros((height, width, 4))
+        if not osmesa.OSMesaMakeCurrent(self._context, self._buffer, GL_UNSIGNED_BYTE, width, height):
+            raise Exception("Unable to make the OSMesa context current")
+
+    def should_close(self) -> bool:
+        """
+        Always False, there is no window to close
+        """
+        return False
+
+    def destroy(self) -> None:
+        """
+        Destroys the context
+        """
+        self._osmesa.OSMesaDestroyContext(self._context)
+
+
+def create_context(width: int, height: int) -> object:
+    """
+    Creates an OpenGL context with the backend selected at startup and makes it current on this thread
+
+    Args:
+        width (int): the width of the default surface
+        height (int): the height of the default surface
+
+    Returns:
+        object: the context
+    """
+    contexts = {
+        "glfw": Glfw_Context,
+        "egl": Egl_Context,
+        "osmesa": Osmesa_Context,
+    }
+    log(f"Creating {BACKEND} OpenGL context")
+    return contexts[BACKEND](width, height)
@@ -1,14 +1,46 @@
 from PIL import Image
-import io
 from io import BytesIO
-import base64
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import bosdyn
+import shutil
+import subprocess
 import time
 
-from SpotSite.utils import start_thread
-from SpotSite.spot_images import stitch_images
+from SpotSite.utils import start_thread, read_json, get_event_loop, print_exception
+from SpotSite.spot_images.camera_fetcher import Camera_Fetcher
+from SpotSite.spot_images.frame_buffer import Frame_Buffer
+from SpotSite.spot_images.jpeg_encoder import Jpeg_Encoder_Pool, create_jpeg_encoder
+from SpotSite.spot_images.video_pipeline import Pipeline_Stage, Video_Pipeline
 from SpotSite.spot_logging import log
-from SpotSite.utils import output_to_socket
+from SpotSite.socket_messages import video_frame_flags
+from SpotSite.utils import (output_to_socket, output_renditions_to_socket, get_video_rendition_levels,
+                            get_socket_video_stats, get_subscribed_cameras)
+
+# The image sources each camera in the video feed is made from
+CAMERA_SOURCES = {
+    "front": ("frontright_fisheye_image", "frontleft_fisheye_image"),
+    "back": ("back_fisheye_image",),
+    "left": ("left_fisheye_image",),
+    "right": ("right_fisheye_image",),
+    "frontleft": ("frontleft_fisheye_image",),
+    "frontright": ("frontright_fisheye_image",),
+}
+
+# How long the fetch stage waits before checking for subscribers again when nobody is watching, in seconds
+NO_SUBSCRIBERS_SLEEP = 0.2
+
+# How often clients are updated with the robot state, in seconds
+ROBOT_STATE_PERIOD = 0.1
+
+# The cameras sent as tiles of the front view when it cannot be stitched, from left to right, and their sources
+FRONT_TILES = (("frontright", "frontright_fisheye_image"), ("frontleft", "frontleft_fisheye_image"))
+
+# The front fisheye cameras are mounted sideways, their images are upright after a quarter turn clockwise
+FRONT_QUARTER_TURNS = 1
+
+# Rotates JPEGs without decoding them, None if libjpeg's jpegtran is not installed
+JPEGTRAN = shutil.which("jpegtran")
 
 
 class Image_Handler:
@@ -17,13 +49,30 @@ class Image_Handler:
         self._show_video_feed = False
         self._update_robot_state = update_robot_state_func
         self._image_client = image_client
+        self._camera_fetcher = None
+        self._jpeg_encoder = None
+        self._pipeline = None
+        self._video_task = None
+        self._frame_sequences = {}
+
+        self._video_config = read_json("SpotSite/config.json").get("video", {})
+        # The cameras clients may subscribe to
+        self._cameras = self._video_config.get("cameras", list(CAMERA_SOURCES))
+        self._front_fallback = self._video_config.get("front_fallback", "passthrough")
+        self._lossless_rotation = self._video_config.get("lossless_rotation", False) and JPEGTRAN is not None
+        # How many times smaller than the full frame each rendition level is
+        self._rendition_factors = self._video_config.get("renditions", [1, 2, 4])
+        # The newest full size frame of each camera, for readers other than the websockets
+        self.frame_buffer = Frame_Buffer()
 
     def set_show_video_feed(self, value):
         self._show_video_feed = value
 
     def _start_video_loop(self, update_robot_state_func, image_client) -> None:
         """
-        Creates a thread to start the main video loop
+        Starts the main video loop as a task on the event loop, in place of the one already running if there is one
+
+        Safe to call from any thread
         """
 
         self._update_robot_state = update_robot_state_func
@@ -32,19 +81,112 @@ class Image_Handler:
         if self._update_robot_state is None or self._image_client is None:
             return
 
-        start_thread(self._video_loop)
+        future = asyncio.run_coroutine_threadsafe(self._replace_video_loop(), get_event_loop())
+        future.add_done_callback(self._video_loop_done)
+
+    async def _replace_video_loop(self) -> None:
+        """
+        Cancels the video loop that is running and waits for it to clean up, then runs a new one
 
-    def _video_loop(self) -> None:
+        The old loop would otherwise keep running after a reconnect, since it only stops once it sees
+        ```_show_video_feed``` turned off, and two loops would fetch through the same client
+        """
+        # Checked again after every wait, in case another restart started its loop in the meantime
+        while self._video_task is not None and not self._video_task.done():
+            self._video_task.cancel()
+            await asyncio.wait({self._video_task})
+        self._video_task = asyncio.current_task()
+        await self._video_loop()
+
+    def _video_loop_done(self, future: object) -> None:
+        """
+        Logs why the video loop ended, otherwise an error in it would be lost with its future
+
+        Args:
+            future (Future): the future of the video loop
+        """
+        if future.cancelled():
+            log("Video loop cancelled")
+            return
+        try:
+            future.result()
+        except Exception:
+            print_exception(-1)
+
+    async def _video_loop(self) -> None:
         """
         Houses and runs the main video feed loop
+
+        Fetching, stitching, encoding, and sending each run as their own task (see video_pipeline.py). Images are
+        fetched with the SDK's async calls and sent from the event loop, so neither needs a thread. Stitching and
+        updating the robot state block, so they run on executors and do not slow down the video or the loop
         """
-        self.image_stitcher = stitch_images.Stitcher()
-        start_thread(self.image_stitcher.start_glfw_loop)
+        loop = asyncio.get_running_loop()
+        # The cleanup below uses these locals, the attributes belong to whichever loop runs next
+        self._camera_fetcher = Camera_Fetcher(self._image_client,
+                                              mode=self._video_config.get("fetch_mode", "batched"))
+        jpeg_config = self._video_config.get("jpeg", {})
+        jpeg_encoder = self._jpeg_encoder = Jpeg_Encoder_Pool(create_jpeg_encoder(jpeg_config),
+                                                              workers=jpeg_config.get("workers", 2))
+        log(f"Encoding video with the {jpeg_encoder.encoder.name} JPEG encoder")
+        image_stitcher = self.image_stitcher = self._create_stitcher()
+        # The OpenGL context belongs to the thread that created it, so the stitcher keeps its own thread
+        start_thread(image_stitcher.start_render_loop)
+        stitch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="video-stitch")
+
+        pipeline = self._pipeline = Video_Pipeline([
+            Pipeline_Stage("fetch", self._fetch_images, is_source=True, idle_sleep=NO_SUBSCRIBERS_SLEEP),
+            Pipeline_Stage("stitch", self._stitch_frame, executor=stitch_executor),
+            Pipeline_Stage("encode", self._encode_frame),
+            Pipeline_Stage("send", self._send_frame),
+        ])
+        pipeline.start()
         log("Started video loop")
-        while self._show_video_feed:
-            time.sleep(0.01)
-            self._get_images()
-            self._update_robot_state()
+
+        try:
+            while self._show_video_feed:
+                await loop.run_in_executor(None, self._update_robot_state)
+                await asyncio.sleep(ROBOT_STATE_PERIOD)
+        finally:
+            pipeline.stop()
+            image_stitcher.stop()
+            jpeg_encoder.shutdown()
+            stitch_executor.shutdown(wait=False)
+            log("Stopped video loop")
+
+    def _create_stitcher(self) -> object:
+        """
+        Creates the stitcher chosen in config.json
+
+        "cpu" stitches with NumPy and needs no GPU, anything else uses OpenGL. The OpenGL stitcher is only
+        imported when it is used, so the server runs on machines without OpenGL
+
+        Returns:
+            object: the stitcher
+        """
+        if self._video_config.get("stitcher", "opengl") == "cpu":
+            from SpotSite.spot_images.cpu_stitcher import Cpu_Stitcher
+            return Cpu_Stitcher()
+
+        from SpotSite.spot_images import stitch_images
+        return stitch_images.Stitcher()
+
+    def get_video_stats(self) -> dict:
+        """
+        Returns information about the performance of the video feed
+
+        Returns:
+            dict: the fetch timings of each image source, the throughput and queue depth of each pipeline stage,
+                the video quality of each socket, and the stitcher timings if the stitcher has them
+        """
+        stats = {
+            "fetch": self._camera_fetcher.get_timings() if self._camera_fetcher else {},
+            "stages": self._pipeline.get_stats() if self._pipeline else [],
+            "sockets": get_socket_video_stats(),
+        }
+        if hasattr(self.image_stitcher, "get_stats"):
+            stats["stitch"] = self.image_stitcher.get_stats()
+        return stats
 
     def _stitch_images(self, image1: bosdyn.client.image, image2: bosdyn.client.image) -> Image:
         """
@@ -63,38 +205,244 @@ class Image_Handler:
             output_to_socket(
                 -1, "<red><bold>Issue with cameras, robot must be rebooted</bold></red>", all=True)
 
-    def _encode_base64(self, image: Image) -> str:
+    def _next_sequence(self, camera_name: str) -> int:
         """
-        Encodes an image in base64
+        Returns the next frame sequence number for a camera
 
         Args:
-            image (Image): The image
+            camera_name (str): The name of the camera
 
         Returns:
-            str: The image bytes encoded in base64
+            int: The sequence number
         """
-        if image is None:
-            return
-        buf = io.BytesIO()
-        image.save(buf, format='JPEG')
+        sequence = self._frame_sequences.get(camera_name, 0)
+        self._frame_sequences[camera_name] = sequence + 1
+        return sequence
+
+    def _subscribed_cameras(self) -> list:
+        """
+        Returns the cameras at least one websocket subscribed to or a frame buffer reader reads, out of the cameras
+        enabled in config.json
+
+        Returns:
+            list: the names of the cameras
+        """
+        subscribed = get_subscribed_cameras() | self.frame_buffer.active_cameras()
+        return [camera_name for camera_name in self._cameras
+                if camera_name in subscribed and camera_name in CAMERA_SOURCES]
+
+    def _sources(self, cameras: list) -> list:
+        """
+        Returns every image source needed by cameras
+
+        Args:
+            cameras (list): the names of the cameras
+
+        Returns:
+            list: the names of the image sources
+        """
+        sources = []
+        for camera_name in cameras:
+            for source in CAMERA_SOURCES[camera_name]:
+                if source not in sources:
+                    sources.append(source)
+        return sources
+
+    async def _fetch_images(self) -> dict:
+        """
+        The fetch stage: gets every image the subscribed cameras need with one round trip to the robot
+
+        Nothing is fetched while no client is subscribed to a camera
+
+        Returns:
+            dict: the frame, holding the time the images were fetched, the cameras they are for, and the image
+                responses by source name. None if no client is subscribed to a camera
+        """
+        cameras = self._subscribed_cameras()
+        if not cameras:
+            return None
 
-        bytes_image = buf.getvalue()
+        responses = await self._camera_fetcher.fetch(self._sources(cameras))
+        # The receive time, the acquisition time of the responses is on the robot's clock, not the server's
+        return {
+            "timestamp": time.time(),
+            "cameras": cameras,
+            "responses": responses,
+            "images": {},
+            "flags": {}
+        }
 
-        return base64.b64encode(bytes_image).decode("utf8")
+    def _stitch_frame(self, frame: dict) -> dict:
+        """
+        The stitch stage: creates the image shown for each camera
+
+        The front camera is stitched. If it cannot be, the two front images are either passed on untouched as
+        tiles the client places side by side, or placed side by side here, depending on "front_fallback" in
+        config.json. Every other camera is passed on as its JPEG bytes
+
+        Args:
+            frame (dict): the frame from the fetch stage
+
+        Returns:
+            dict: the frame, with the image and flags for each camera
+        """
+        responses = frame["responses"]
+        for camera_name in frame["cameras"]:
+            # The raw front images may already be in the frame as tiles of the front view
+            if camera_name in frame["images"]:
+                continue
+            try:
+                if camera_name == "front":
+                    front_right = responses["frontright_fisheye_image"]
+                    front_left = responses["frontleft_fisheye_image"]
+                    image = self._stitch_images(front_right, front_left)
+                    # Frame buffer readers cannot compose tiles, so they get the composite instead
+                    if image is None and self._front_fallback == "passthrough" \
+                            and "front" not in self.frame_buffer.active_cameras():
+                        self._pass_through_front(frame)
+                        continue
+                    image = self._stitched_or_stamped(
+                        image, front_right, front_left)
+                else:
+                    source, = CAMERA_SOURCES[camera_name]
+                    image = responses[source].shot.image.data
+            except (KeyError, AttributeError):
+                continue
+            frame["images"][camera_name] = image
+        return frame
+
+    async def _encode_frame(self, frame: dict) -> dict:
+        """
+        The encode stage: encodes each image at every rendition level a socket currently wants
+
+        The renditions are encoded once and shared by every socket. A JPEG is passed on untouched at full size,
+        and only decoded for the smaller levels. Everything is scaled and encoded at the same time on the encoder
+        pool, while the event loop waits
+
+        Args:
+            frame (dict): the frame from the stitch stage
+
+        Returns:
+            dict: the frame, with the JPEG bytes at each rendition level for each camera
+        """
+        levels = {level for level in get_video_rendition_levels() if level < len(self._rendition_factors)}
+        # Frame buffer readers always get the full size frame
+        if self.frame_buffer.active_cameras() or not levels:
+            levels.add(0)
+
+        renditions = {camera_name: {} for camera_name in frame["images"]}
+        encoding = {}
+        for camera_name, image in frame["images"].items():
+            for level in levels:
+                factor = self._rendition_factors[level]
+                if not isinstance(image, Image.Image) and factor == 1:
+                    renditions[camera_name][level] = image
+                else:
+                    encoding[(camera_name, level)] = asyncio.wrap_future(self._jpeg_encoder.submit(
+                        image, lambda image, factor=factor: self._scale_image(image, factor)))
+
+        jpegs = await asyncio.gather(*encoding.values())
+        for (camera_name, level), jpeg in zip(encoding, jpegs):
+            renditions[camera_name][level] = jpeg
+        frame["images"] = renditions
+        return frame
+
+    def _scale_image(self, image: any, factor: int) -> Image:
+        """
+        Scales an image down for a rendition level
+
+        JPEGs are decoded straight to the smaller size, which libjpeg does by skipping most of the decoding work
+
+        Args:
+            image (Image, bytes): the image, or its JPEG bytes
+            factor (int): how many times smaller the rendition is
+
+        Returns:
+            Image: the scaled image
+        """
+        if not isinstance(image, Image.Image):
+            image = Image.open(BytesIO(image))
+        # The size comes from the full image, draft already shrinks the image it decodes
+        size = (max(1, image.width // factor), max(1, image.height // factor))
+        if image.format == "JPEG":
+            image.draft(image.mode, size)
+        if image.size == size:
+            return image
+        return image.resize(size, Image.BILINEAR)
+
+    async def _send_frame(self, frame: dict) -> dict:
+        """
+        The send stage: updates the clients with every rendition of the image from each camera, and publishes the
+        full size image to the frame buffer
 
-    def _get_images(self) -> None:
+        Args:
+            frame (dict): the frame from the encode stage
+
+        Returns:
+            dict: the frame
+        """
+        for camera_name, images in frame["images"].items():
+            if not images:
+                continue
+            sequence = self._next_sequence(camera_name)
+            flags = frame["flags"].get(camera_name, 0)
+            output_renditions_to_socket(camera_name, images, sequence, frame["timestamp"], flags)
+            if 0 in images:
+                self.frame_buffer.publish(camera_name, images[0], sequence, frame["timestamp"])
+        return frame
+
+    def _pass_through_front(self, frame: dict) -> None:
+        """
+        Adds the two front images to the frame as tiles of the front view, without decoding or encoding them
+
+        Args:
+            frame (dict): the frame from the fetch stage
         """
-        Gets and displays all relevant images for the video feed
+        for tile, (camera_name, source) in enumerate(FRONT_TILES):
+            image, quarter_turns = self._rotate_jpeg(frame["responses"][source].shot.image.data,
+                                                     FRONT_QUARTER_TURNS)
+            frame["images"][camera_name] = image
+            frame["flags"][camera_name] = video_frame_flags(quarter_turns, tile_of="front", tile=tile,
+                                                            tiles=len(FRONT_TILES))
+
+    def _rotate_jpeg(self, image: bytes, quarter_turns: int) -> tuple:
         """
+        Rotates a JPEG losslessly with jpegtran, if "lossless_rotation" is enabled in config.json
+
+        jpegtran rotates the compressed blocks of the JPEG instead of its pixels, so nothing is decoded or encoded
+
+        Args:
+            image (bytes): the JPEG
+            quarter_turns (int): quarter turns to rotate the image clockwise
+
+        Returns:
+            tuple: the JPEG, and the quarter turns the client still has to rotate it
+        """
+        if not self._lossless_rotation or quarter_turns % 4 == 0:
+            return image, quarter_turns
         try:
-            self._send_image("front")
-            self._send_image("back")
-        except Exception as e:
-            pass
+            rotated = subprocess.run([JPEGTRAN, "-rotate", str(quarter_turns % 4 * 90), "-trim", "-copy", "none"],
+                                     input=image, capture_output=True, check=True, timeout=1).stdout
+        except (OSError, subprocess.SubprocessError) as e:
+            log(f"jpegtran failed, the client will rotate the front images: {e}")
+            self._lossless_rotation = False
+            return image, quarter_turns
+        return rotated, 0
+
+    def _stitched_or_stamped(self, image: Image, front_right, front_left) -> Image:
+        """
+        Returns the stitched image, or the two front images placed side by side if stitching is not available
 
-    def _stitched_or_stamped(self, image: Image, front_right, front_left) -> str:
+        Args:
+            image (Image): The stitched image, None if stitching is not available
+            front_right (bosdyn.client.image): The right camera image
+            front_left (bosdyn.client.image): The left camera image
+
+        Returns:
+            Image: The image shown for the front camera
+        """
         if image is not None:
-            return self._encode_base64(image)
+            return image
         front_right = front_right.shot.image.data
         front_left = front_left.shot.image.data
 
@@ -110,35 +458,4 @@ class Image_Handler:
         full_image.paste(front_left, (640, 0))
         full_image.paste(front_right, (0, 0))
 
-        return self._encode_base64(full_image)
-
-    def _send_image(self, camera_name: str) -> None:
-        """
-        Gets and updates the client with an image
-
-        Args:
-            camera_name (str): The name of the desired image
-        """
-        try:
-            if camera_name == "front":
-                front_right = self._image_client.get_image_from_sources(
-                    ["frontright_fisheye_image"])[0]
-                front_left = self._image_client.get_image_from_sources(
-                    ["frontleft_fisheye_image"])[0]
-                image = self._stitch_images(front_right, front_left)
-                image = self._stitched_or_stamped(
-                    image, front_right, front_left)
-            if camera_name == "back":
-                back = self._image_client.get_image_from_sources(
-                    ["back_fisheye_image"])[0].shot.image.data
-                image = base64.b64encode(back).decode("utf8")
-
-            if camera_name == "left":
-                left = self._image_client.get_image_from_sources(
-                    ["left_fisheye_image"])[0].shot.image.data
-                image = base64.b64encode(left).decode("utf8")
-
-            output_to_socket(-1, image,
-                                all=True, type=("@" + camera_name))
-        except AttributeError:
-            pass
+        return full_image
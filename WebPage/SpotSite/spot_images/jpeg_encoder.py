@@ -0,0 +1,211 @@
+"""
+Encodes video frames as JPEGs
+
+Two encoders are available. "turbo" uses the libjpeg-turbo bindings from PyTurboJPEG, which are in
+requirements-optional.txt and are only used when they are installed. "pil" uses Pillow, which is always available.
+"auto" picks turbo when it can be loaded and falls back to pil otherwise.
+
+Both encoders release the GIL while encoding, so frames are encoded on a small pool of worker threads.
+
+Classes:
+
+    Pil_Jpeg_Encoder
+    Turbo_Jpeg_Encoder
+    Jpeg_Encoder_Pool
+
+Functions:
+
+    create_jpeg_encoder(config) -> object
+"""
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from SpotSite.spot_logging import log
+
+# Chroma subsampling settings accepted in config.json
+SUBSAMPLING = ("4:4:4", "4:2:2", "4:2:0")
+
+
+class Pil_Jpeg_Encoder:
+    """
+    Encodes JPEGs with Pillow
+
+    Each worker thread writes into its own output buffer, which is reused for every frame it encodes
+
+    Attributes:
+        name (str): the name of the encoder
+        _quality (int): the JPEG quality, from 1 to 95
+        _subsampling (str): the chroma subsampling, one of SUBSAMPLING
+        _optimize (bool): whether to compute optimal Huffman tables, smaller frames for more time
+        _buffers (local): the output buffer of each thread
+
+    Methods:
+        encode(image):
+            Encodes an image as a JPEG
+    """
+
+    def __init__(self, quality: int = 75, subsampling: str = "4:2:0", optimize: bool = False):
+        self.name = "pil"
+        self._quality = quality
+        self._subsampling = subsampling
+        self._optimize = optimize
+        self._buffers = threading.local()
+
+    def encode(self, image: Image) -> bytes:
+        """
+        Encodes an image as a JPEG
+
+        Args:
+            image (Image): the image
+
+        Returns:
+            bytes: the JPEG bytes
+        """
+        buffer = getattr(self._buffers, "buffer", None)
+        if buffer is None:
+            buffer = self._buffers.buffer = io.BytesIO()
+        buffer.seek(0)
+        buffer.truncate()
+
+        image.save(buffer, format="JPEG", quality=self._quality, subsampling=self._subsampling,
+                   optimize=self._optimize)
+        return buffer.getvalue()
+
+
+class Turbo_Jpeg_Encoder:
+    """
+    Encodes JPEGs with libjpeg-turbo
+
+    libjpeg-turbo has no setting for optimized Huffman tables, so optimize selects its accurate DCT instead of
+    its fast DCT
+
+    Attributes:
+        name (str): the name of the encoder
+        _turbo_jpeg (TurboJPEG): the libjpeg-turbo bindings
+        _quality (int): the JPEG quality, from 1 to 100
+        _subsampling (int): the libjpeg-turbo chroma subsampling constant
+        _flags (int): the libjpeg-turbo encode flags
+        _pixel_formats (dict): the libjpeg-turbo pixel format of each image mode
+        _gray (int): the libjpeg-turbo subsampling constant for grayscale images
+
+    Methods:
+        encode(image):
+            Encodes an image as a JPEG
+    """
+
+    def __init__(self, quality: int = 75, subsampling: str = "4:2:0", optimize: bool = False):
+        import numpy
+        import turbojpeg
+        self._numpy = numpy
+
+        self.name = "turbo"
+        self._turbo_jpeg = turbojpeg.TurboJPEG()
+        self._quality = quality
+        self._subsampling = {
+            "4:4:4": turbojpeg.TJSAMP_444,
+            "4:2:2": turbojpeg.TJSAMP_422,
+            "4:2:0": turbojpeg.TJSAMP_420,
+        }[subsampling]
+        self._flags = turbojpeg.TJFLAG_ACCURATEDCT if optimize else turbojpeg.TJFLAG_FASTDCT
+        self._pixel_formats = {
+            "RGB": turbojpeg.TJPF_RGB,
+            "RGBA": turbojpeg.TJPF_RGBA,
+            "L": turbojpeg.TJPF_GRAY,
+        }
+        self._gray = turbojpeg.TJSAMP_GRAY
+
+    def encode(self, image: Image) -> bytes:
+        """
+        Encodes an image as a JPEG
+
+        Args:
+            image (Image): the image
+
+        Returns:
+            bytes: the JPEG bytes
+        """
+        if image.mode not in self._pixel_formats:
+            image = image.convert("RGB")
+        subsampling = self._gray if image.mode == "L" else self._subsampling
+
+        # asarray shares the image's memory when it can, so the pixels are not copied before encoding
+        pixels = self._numpy.asarray(image)
+        if pixels.ndim == 2:
+            pixels = pixels[:, :, None]
+        return self._turbo_jpeg.encode(pixels, quality=self._quality, pixel_format=self._pixel_formats[image.mode],
+                                       jpeg_subsample=subsampling, flags=self._flags)
+
+
+def create_jpeg_encoder(config: dict) -> object:
+    """
+    Creates the JPEG encoder chosen in config.json
+
+    Args:
+        config (dict): the "jpeg" section of the video config, with "encoder", "quality", "subsampling" and "optimize"
+
+    Returns:
+        object: the encoder
+    """
+    encoder = config.get("encoder", "auto")
+    subsampling = config.get("subsampling", "4:2:0")
+    if subsampling not in SUBSAMPLING:
+        log(f"Unknown JPEG subsampling {subsampling}, using 4:2:0")
+        subsampling = "4:2:0"
+    settings = {
+        "quality": int(config.get("quality", 75)),
+        "subsampling": subsampling,
+        "optimize": bool(config.get("optimize", False)),
+    }
+
+    if encoder in ("auto", "turbo"):
+        try:
+            return Turbo_Jpeg_Encoder(**settings)
+        except (ImportError, OSError, RuntimeError) as e:
+            if encoder == "turbo":
+                log(f"Unable to load libjpeg-turbo, encoding with Pillow: {e}")
+    return Pil_Jpeg_Encoder(**settings)
+
+
+class Jpeg_Encoder_Pool:
+    """
+    Encodes frames on a pool of worker threads
+
+    Attributes:
+        encoder (object): the encoder used by every worker
+        _pool (ThreadPoolExecutor): the worker threads
+
+    Methods:
+        submit(image, prepare):
+            Starts encoding an image as a JPEG on a worker thread
+        shutdown():
+            Stops the worker threads
+    """
+
+    def __init__(self, encoder: object, workers: int = 2):
+        self.encoder = encoder
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="jpeg-encode")
+
+    def submit(self, image: Image, prepare: callable = None) -> object:
+        """
+        Starts encoding an image as a JPEG on a worker thread
+
+        Args:
+            image (Image): the image
+            prepare (callable, optional): run on the image on the worker thread before it is encoded, ex. to scale it.
+                Defaults to None.
+
+        Returns:
+            Future: the future of the JPEG bytes, can be awaited with ```asyncio.wrap_future```
+        """
+        if prepare is None:
+            return self._pool.submit(self.encoder.encode, image)
+        return self._pool.submit(lambda: self.encoder.encode(prepare(image)))
+
+    def shutdown(self) -> None:
+        """
+        Stops the worker threads
+        """
+        self._pool.shutdown(wait=False)
@@ -0,0 +1,253 @@
+# Copyright (c) 2021 Boston Dynamics, Inc.  All rights reserved.
+#
+# Downloading, reproducing, distributing or otherwise using the SDK Software
+# is subject to the terms and conditions of the Boston Dynamics Software
+# Development Kit License (20191101-BDSDK-SL).
+
+"""
+Geometry shared by the OpenGL and CPU stitchers. Does not need OpenGL.
+
+Classes:
+
+    ImagePreppedForOpenGL (from example)
+    Prepared_Image_Cache
+
+Functions:
+
+    proto_vec_T_numpy  (from example)
+    mat4mul3  (from example)
+    normalize  (from example)
+    perspective_matrix
+    look_at_matrix
+    virtual_camera(image_1, image_2) -> tuple
+
+Misc Variables:
+
+    RECT_SZ_METERS (float): half the size of the plane the images are projected onto
+    RECT_STITCHING_DISTANCE_METERS (float): how far in front of the virtual camera the plane is
+    FIELD_OF_VIEW (float): the vertical field of view of the virtual camera, in degrees
+"""
+
+import io
+import math
+import numpy
+
+from PIL import Image
+from bosdyn.api import image_pb2
+from bosdyn.client.frame_helpers import BODY_FRAME_NAME, get_vision_tform_body, get_a_tform_b
+
+RECT_SZ_METERS = 7
+RECT_STITCHING_DISTANCE_METERS = 2.0
+FIELD_OF_VIEW = 110
+
+
+class ImagePreppedForOpenGL():
+    """Prep image for OpenGL from Spot image_response."""
+
+    def extract_image(self, image_response):
+        """Return numpy_array of input image_response image."""
+        image_format = image_response.shot.image.format
+
+        if image_format == image_pb2.Image.FORMAT_RAW:
+            raise Exception("Won't work.  Yet.")
+        elif image_format == image_pb2.Image.FORMAT_JPEG:
+            numpy_array = numpy.asarray(Image.open(
+                io.BytesIO(image_response.shot.image.data)))
+        else:
+            raise Exception("Won't work.")
+
+        return numpy_array
+
+    def camera_geometry(self, image_response):
+        """Return body_T_image_sensor and the camera projection matrix of input image_response."""
+        body_T_image_sensor = get_a_tform_b(image_response.shot.transforms_snapshot,
+                                            BODY_FRAME_NAME, image_response.shot.frame_name_image_sensor)
+        if not body_T_image_sensor:
+            raise Exception("Won't work.")
+
+        if image_response.source.pinhole:
+            resolution = numpy.asarray([
+                image_response.source.cols,
+                image_response.source.rows])
+
+            focal_length = numpy.asarray([
+                image_response.source.pinhole.intrinsics.focal_length.x,
+                image_response.source.pinhole.intrinsics.focal_length.y])
+
+            principal_point = numpy.asarray([
+                image_response.source.pinhole.intrinsics.principal_point.x,
+                image_response.source.pinhole.intrinsics.principal_point.y])
+        else:
+            raise Exception("Won't work.")
+
+        camera_projection_mat = numpy.eye(4)
+        camera_projection_mat[0, 0] = (focal_length[0] / resolution[0])
+        camera_projection_mat[0, 2] = (principal_point[0] / resolution[0])
+        camera_projection_mat[1, 1] = (focal_length[1] / resolution[1])
+        camera_projection_mat[1, 2] = (principal_point[1] / resolution[1])
+
+        return body_T_image_sensor, camera_projection_mat
+
+    def __init__(self, image_response, camera_geometry_cache=None):
+        """
+        camera_geometry_cache is an optional dict, by image source name, of the camera extrinsics and intrinsics.
+        They do not change while the robot is connected, so they only have to be computed once.
+        """
+        self.image = self.extract_image(image_response)
+        self.vision_T_body = get_vision_tform_body(
+            image_response.shot.transforms_snapshot)
+
+        source_name = image_response.source.name
+        if camera_geometry_cache is not None and source_name in camera_geometry_cache:
+            geometry = camera_geometry_cache[source_name]
+        else:
+            geometry = self.camera_geometry(image_response)
+            if camera_geometry_cache is not None:
+                camera_geometry_cache[source_name] = geometry
+        self.body_T_image_sensor, self.camera_projection_mat = geometry
+
+        sensor_T_vo = (self.vision_T_body * self.body_T_image_sensor).inverse()
+
+        self.MVP = self.camera_projection_mat.dot(sensor_T_vo.to_matrix())
+
+
+class Prepared_Image_Cache:
+    """
+    Caches the newest ImagePreppedForOpenGL of each image source
+
+    An image is only decoded and its matrices computed once, no matter how many times it is drawn.
+    The camera extrinsics and intrinsics are cached for the whole session.
+
+    Attributes:
+        _images (dict): the acquisition time and prepared image of the newest image from each source
+        _camera_geometry (dict): the camera extrinsics and intrinsics of each source
+
+    Methods:
+        get(image_response):
+            Returns the prepared image, preparing it only if it is new
+        clear():
+            Forgets every cached image and camera
+    """
+
+    def __init__(self):
+        self._images = {}
+        self._camera_geometry = {}
+
+    def get(self, image_response) -> ImagePreppedForOpenGL:
+        """
+        Returns the prepared image, preparing it only if it is new
+
+        Args:
+            image_response (bosdyn.client.image): the image
+
+        Returns:
+            ImagePreppedForOpenGL: the prepared image
+        """
+        source_name = image_response.source.name
+        acquisition_time = image_response.shot.acquisition_time
+        key = (acquisition_time.seconds, acquisition_time.nanos)
+
+        cached = self._images.get(source_name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        prepared = ImagePreppedForOpenGL(image_response, self._camera_geometry)
+        self._images[source_name] = (key, prepared)
+        return prepared
+
+    def clear(self) -> None:
+        """
+        Forgets every cached image and camera
+        """
+        self._images = {}
+        self._camera_geometry = {}
+
+
+def proto_vec_T_numpy(vec):
+    return numpy.array([vec.x, vec.y, vec.z])
+
+
+def mat4mul3(mat, vec, vec4=1):
+    ret = numpy.matmul(mat, numpy.append(vec, vec4))
+    return ret[:-1]
+
+
+def normalize(vec):
+    norm = numpy.linalg.norm(vec)
+    if norm == 0:
+        raise ValueError("norm function returned 0.")
+    return vec / norm
+
+
+def perspective_matrix(fovy: float, aspect: float, near: float, far: float) -> numpy.ndarray:
+    """
+    Returns the same projection matrix as gluPerspective, so GLU is not needed
+
+    Args:
+        fovy (float): the vertical field of view, in degrees
+        aspect (float): the width of the view divided by its height
+        near (float): the distance to the near clipping plane
+        far (float): the distance to the far clipping plane
+
+    Returns:
+        numpy.ndarray: the 4x4 projection matrix
+    """
+    f = 1 / math.tan(math.radians(fovy) / 2)
+    return numpy.array([
+        [f / aspect, 0, 0, 0],
+        [0, f, 0, 0],
+        [0, 0, (far + near) / (near - far), 2 * far * near / (near - far)],
+        [0, 0, -1, 0],
+    ])
+
+
+def look_at_matrix(eye, center, up) -> numpy.ndarray:
+    """
+    Returns the same view matrix as gluLookAt, so GLU is not needed
+
+    Args:
+        eye (numpy.ndarray): the position of the camera
+        center (numpy.ndarray): the point the camera looks at
+        up (numpy.ndarray): the up direction of the camera
+
+    Returns:
+        numpy.ndarray: the 4x4 view matrix
+    """
+    forward = normalize(numpy.asarray(center, dtype=float) - eye)
+    side = normalize(numpy.cross(forward, up))
+    true_up = numpy.cross(side, forward)
+
+    view = numpy.eye(4)
+    view[0, :3] = side
+    view[1, :3] = true_up
+    view[2, :3] = -forward
+    view[:3, 3] = -view[:3, :3].dot(eye)
+    return view
+
+
+def virtual_camera(image_1: ImagePreppedForOpenGL, image_2: ImagePreppedForOpenGL) -> tuple:
+    """
+    Returns the position and direction of the virtual camera the stitched image is seen from
+
+    Args:
+        image_1 (ImagePreppedForOpenGL): the image from the right camera
+        image_2 (ImagePreppedForOpenGL): the image from the left camera
+
+    Returns:
+        tuple: the position and the unit direction of the virtual camera, both in the body frame
+    """
+    eye_wrt_body = proto_vec_T_numpy(image_1.body_T_image_sensor.position) \
+        + proto_vec_T_numpy(image_2.body_T_image_sensor.position)
+
+    # Add the two real camera norms together to get the fake camera norm.
+    eye_norm_wrt_body = numpy.array(image_1.body_T_image_sensor.rot.transform_point(0, 0, 1)) \
+        + numpy.array(image_2.body_T_image_sensor.rot.transform_point(0, 0, 1))
+
+    # Make the virtual camera centered.
+    eye_wrt_body[1] = 0
+    eye_norm_wrt_body[1] = 0
+
+    # Make sure our normal has length 1
+    eye_norm_wrt_body = normalize(eye_norm_wrt_body)
+
+    return eye_wrt_body, eye_norm_wrt_body
@@ -7,88 +7,43 @@
 """
 Stitch frontleft_fisheye_image, frontright_fisheye_image from images.protodata.
 
+The geometry shared with the CPU stitcher is in stitch_geometry.py
+
 Classes:
 
-    ImagePreppedForOpenGL (from example)
     ImageInsideOpenGL (from example)
     CompiledShader (from example)
     Stitcher
     
 Functions:
 
-    proto_vec_T_numpy  (from example)
-    mat4mul3  (from example)
-    normalize  (from example)
     draw_geometry  (from example)
     draw_routine  (from example)
 """
 
 import bosdyn.api
 import bosdyn.client.util
-import io
+import ctypes
 import numpy
-import time
+import threading
 
+# Must be imported before OpenGL.GL so the offscreen backend can be selected
+from SpotSite.spot_images import gl_context
 from OpenGL.GL import *
 from OpenGL.GL import shaders, GL_VERTEX_SHADER
-from OpenGL.GLU import *
-import glfw
 from PIL import Image
-from PIL import ImageOps
-from bosdyn.api import image_pb2
-from bosdyn.client.frame_helpers import BODY_FRAME_NAME, get_vision_tform_body, get_a_tform_b
-
-
-class ImagePreppedForOpenGL():
-    """Prep image for OpenGL from Spot image_response."""
+from SpotSite.spot_images.stitch_geometry import (Prepared_Image_Cache, RECT_SZ_METERS, RECT_STITCHING_DISTANCE_METERS,
+                                                  FIELD_OF_VIEW, mat4mul3, normalize, perspective_matrix,
+                                                  look_at_matrix, virtual_camera)
 
-    def extract_image(self, image_response):
-        """Return numpy_array of input image_response image."""
-        image_format = image_response.shot.image.format
+# Mirrors clip space vertically, so the rows of the framebuffer are read back top first and need no flip
+FLIP_Y = numpy.diag([1.0, -1.0, 1.0, 1.0])
 
-        if image_format == image_pb2.Image.FORMAT_RAW:
-            raise Exception("Won't work.  Yet.")
-        elif image_format == image_pb2.Image.FORMAT_JPEG:
-            numpy_array = numpy.asarray(Image.open(
-                io.BytesIO(image_response.shot.image.data)))
-        else:
-            raise Exception("Won't work.")
-
-        return numpy_array
-
-    def __init__(self, image_response):
-        self.image = self.extract_image(image_response)
-        self.body_T_image_sensor = get_a_tform_b(image_response.shot.transforms_snapshot,
-                                                 BODY_FRAME_NAME, image_response.shot.frame_name_image_sensor)
-        self.vision_T_body = get_vision_tform_body(
-            image_response.shot.transforms_snapshot)
-        if not self.body_T_image_sensor:
-            raise Exception("Won't work.")
-
-        if image_response.source.pinhole:
-            resolution = numpy.asarray([
-                image_response.source.cols,
-                image_response.source.rows])
-
-            focal_length = numpy.asarray([
-                image_response.source.pinhole.intrinsics.focal_length.x,
-                image_response.source.pinhole.intrinsics.focal_length.y])
-
-            principal_point = numpy.asarray([
-                image_response.source.pinhole.intrinsics.principal_point.x,
-                image_response.source.pinhole.intrinsics.principal_point.y])
-        else:
-            raise Exception("Won't work.")
+# How long stitch() waits for the render thread, in seconds
+STITCH_TIMEOUT = 0.5
 
-        sensor_T_vo = (self.vision_T_body * self.body_T_image_sensor).inverse()
-
-        camera_projection_mat = numpy.eye(4)
-        camera_projection_mat[0, 0] = (focal_length[0] / resolution[0])
-        camera_projection_mat[0, 2] = (principal_point[0] / resolution[0])
-        camera_projection_mat[1, 1] = (focal_length[1] / resolution[1])
-        camera_projection_mat[1, 2] = (principal_point[1] / resolution[1])
-
-        self.MVP = camera_projection_mat.dot(sensor_T_vo.to_matrix())
+# How often the idle render thread checks whether its context was closed, in seconds
+IDLE_CHECK_PERIOD = 0.1
 
 
 class ImageInsideOpenGL():
@@ -128,6 +83,8 @@ class CompiledShader():
 
         self.image1 = None
         self.image2 = None
+        self.image1_array = None
+        self.image2_array = None
 
     def use(self):
         """Call glUseProgram."""
@@ -155,40 +112,26 @@ class CompiledShader():
         glUniform1i(shader_pointer, texture)
 
     def set_image1_texture(self, image):
-        """Set first texture."""
+        """Set first texture. The texture is only uploaded again when the image changed."""
         if self.image1 is None:
             self.image1 = ImageInsideOpenGL(image)
-        else:
+        elif image is not self.image1_array:
             self.image1.update(image)
+        self.image1_array = image
 
         self.set_texture(self.image1.pointer, self.image1_texture, 0)
 
     def set_image2_texture(self, image):
-        """Set second texture."""
+        """Set second texture. The texture is only uploaded again when the image changed."""
         if self.image2 is None:
             self.image2 = ImageInsideOpenGL(image)
-        else:
+        elif image is not self.image2_array:
             self.image2.update(image)
+        self.image2_array = image
 
         self.set_texture(self.image2.pointer, self.image2_texture, 1)
 
 
-def proto_vec_T_numpy(vec):
-    return numpy.array([vec.x, vec.y, vec.z])
-
-
-def mat4mul3(mat, vec, vec4=1):
-    ret = numpy.matmul(mat, numpy.append(vec, vec4))
-    return ret[:-1]
-
-
-def normalize(vec):
-    norm = numpy.linalg.norm(vec)
-    if norm == 0:
-        raise ValueError("norm function returned 0.")
-    return vec / norm
-
-
 def draw_geometry(plane_wrt_vo, plane_norm_wrt_vo, sz_meters):
     """Draw as GL_TRIANGLES."""
     plane_left_wrt_vo = normalize(numpy.cross(
@@ -220,26 +163,11 @@ def draw_geometry(plane_wrt_vo, plane_norm_wrt_vo, sz_meters):
 
 def draw_routine(display, image_1, image_2, program):
     """OpenGL Draw"""
-    rect_sz_meters = 7
-    rect_stitching_distance_meters = 2.0
-
     vo_T_body = image_1.vision_T_body.to_matrix()
 
-    eye_wrt_body = proto_vec_T_numpy(image_1.body_T_image_sensor.position) \
-        + proto_vec_T_numpy(image_2.body_T_image_sensor.position)
-
-    # Add the two real camera norms together to get the fake camera norm.
-    eye_norm_wrt_body = numpy.array(image_1.body_T_image_sensor.rot.transform_point(0, 0, 1)) \
-        + numpy.array(image_2.body_T_image_sensor.rot.transform_point(0, 0, 1))
-
-    # Make the virtual camera centered.
-    eye_wrt_body[1] = 0
-    eye_norm_wrt_body[1] = 0
+    eye_wrt_body, eye_norm_wrt_body = virtual_camera(image_1, image_2)
 
-    # Make sure our normal has length 1
-    eye_norm_wrt_body = normalize(eye_norm_wrt_body)
-
-    plane_wrt_body = eye_wrt_body + eye_norm_wrt_body * rect_stitching_distance_meters
+    plane_wrt_body = eye_wrt_body + eye_norm_wrt_body * RECT_STITCHING_DISTANCE_METERS
 
     plane_wrt_vo = mat4mul3(vo_T_body, plane_wrt_body)
     plane_norm_wrt_vo = mat4mul3(vo_T_body, eye_norm_wrt_body, 0)
@@ -247,15 +175,13 @@ def draw_routine(display, image_1, image_2, program):
     eye_wrt_vo = mat4mul3(vo_T_body, eye_wrt_body)
     up_wrt_vo = mat4mul3(vo_T_body, numpy.array([0, 0, 1]), 0)
 
+    # OpenGL expects matrices in column-major order. The projection is flipped so the image is read back upright
+    projection = FLIP_Y.dot(perspective_matrix(FIELD_OF_VIEW, (display[0] / display[1]), 0.1, 50.0))
     glMatrixMode(GL_PROJECTION)
-    glLoadIdentity()
-    gluPerspective(110, (display[0] / display[1]), 0.1, 50.0)
+    glLoadMatrixd(projection.flatten(order="F"))
 
     glMatrixMode(GL_MODELVIEW)
-    glLoadIdentity()
-    gluLookAt(eye_wrt_vo[0], eye_wrt_vo[1], eye_wrt_vo[2],
-              plane_wrt_vo[0], plane_wrt_vo[1], plane_wrt_vo[2],
-              up_wrt_vo[0], up_wrt_vo[1], up_wrt_vo[2])
+    glLoadMatrixd(look_at_matrix(eye_wrt_vo, plane_wrt_vo, up_wrt_vo).flatten(order="F"))
 
     program.use()
     program.set_camera1_mvp(image_1.MVP)
@@ -263,7 +189,7 @@ def draw_routine(display, image_1, image_2, program):
     program.set_image1_texture(image_1.image)
     program.set_image2_texture(image_2.image)
 
-    draw_geometry(plane_wrt_vo, plane_norm_wrt_vo, rect_sz_meters)
+    draw_geometry(plane_wrt_vo, plane_norm_wrt_vo, RECT_SZ_METERS)
 
 
 class Stitcher:
@@ -274,81 +200,135 @@ class Stitcher:
             _width(int): width of the stitched image
             _height (int): height of the stitched image
             _display (tuple): width and height of the stitched image
-            _window (GLFWwindow*): window used by glfw
+            _context (object): the offscreen OpenGL context (see gl_context.py)
+            _framebuffer (int): the framebuffer object the stitched image is rendered into
+            _color_buffer (int): the renderbuffer holding the color of the framebuffer
+            _pixel_buffer (int): the pixel buffer object the stitched image is read back through
             _program (CompiledShader): compiled shader used to stitch two images
-            _image1 (bosdyn.client.image): the image from the right camera
-            _image2 (bosdyn.client.im the image from the left camera 
-            _images_should_exist (bool): tells whether a new image should exist, so the program knows whether to stitch the existing images
-            _stitched_image (Image): the stitched image
+            _condition (Condition): hands image pairs to the render thread and stitched images back
+            _pending_images (tuple): the request number and image pair waiting to be stitched, None when there is none
+            _requested (int): the request number of the last image pair handed to the render thread
+            _finished (int): the request number of the last image pair the render thread stitched
+            _error (Exception): the error raised while stitching the last image pair, raised again by stitch()
+            _prepared_images (Prepared_Image_Cache): the decoded images and camera matrices, so unchanged images are not prepared again
+            _stitched_image (Image): the image stitched from the last image pair
             _is_running (bool): tells whether the image stitching loop is running
+            _should_stop (bool): tells the image stitching loop to stop
 
         Methods
-            start_glfw_loop():
-                initializes glfw, loads the shaders, and starts the glfw loop
-            _init_glfw():
-                initializes glfw
+            start_render_loop():
+                creates the OpenGL context, loads the shaders, and starts the render loop
+            stop():
+                stops the render loop
+            _init_context():
+                creates the offscreen OpenGL context
+            _init_framebuffer():
+                creates the framebuffer object the stitched image is rendered into
+            _init_pixel_buffer():
+                creates the pixel buffer object the stitched image is read back through
             _load_shaders():
                 compiles shaders and stores the program
-            _start_glfw():
-                starts the glfw loop
+            _start_render_loop():
+                starts the render loop
             _draw_string(string, x, y, color):
                 draws a string to the screen at a specified location in a specified color
             _save_image():
-                reads the stitched image from the glfw window and stores it
-            _do_stitching():
+                reads the stitched image back through the pixel buffer
+            _map_pixel_buffer():
+                copies a frame out of the pixel buffer
+            _wait_for_images():
+                waits until an image pair is handed to the render thread
+            _do_stitching(image_1, image_2):
                 stitches the two images
-            _update_image():
+            _update_image(image_1, image_2):
                 stitches and saves the image
             stitch(image_1, image_2):
-                updates the program with new images and returns the already stitched image
+                hands the images to the render thread and returns the image stitched from them
     """
 
     def __init__(self):
         self._width = 1080
         self._height = 720
         self._display = (self._width, self._height)
-        self._window = None
+        self._context = None
+        self._framebuffer = None
+        self._color_buffer = None
+        self._pixel_buffer = None
 
         self._program = None
-        self._image_1 = None
-        self._image_2 = None
-        self._images_should_exist = True
+        self._condition = threading.Condition()
+        self._pending_images = None
+        self._requested = 0
+        self._finished = 0
+        self._error = None
+        self._prepared_images = Prepared_Image_Cache()
 
         self._stitched_image = None
         self._is_running = False
+        self._should_stop = False
 
-    def start_glfw_loop(self) -> None:
+    def start_render_loop(self) -> None:
         """
-        initializes glfw, loads shaders, and starts the glfw loop
+        creates the OpenGL context, loads shaders, and starts the render loop
 
         """
 
         try:
-            self._init_glfw()
+            self._init_context()
+            self._init_framebuffer()
+            self._init_pixel_buffer()
         except Exception as e:
-            print(f"Error creating glfw context")
+            print(f"Error creating {gl_context.BACKEND} OpenGL context: {e}")
             return
-        # print("Initialized glfw")
         self._load_shaders()
-        self._start_glfw()
+        self._start_render_loop()
 
-    def _init_glfw(self) -> None:
+    def stop(self) -> None:
         """
-        initializes glfw
+        stops the render loop
 
         """
-        try:
-            glfw.init()
-        except:
-            return
-        # glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
-        self._window = glfw.create_window(
-            self._width, self._height, "Image Stitching", None, None)
-        if not self._window:
-            glfw.terminate()
-            raise Exception("No OpenGL Window")
+        with self._condition:
+            self._should_stop = True
+            self._condition.notify_all()
+
+    def _init_context(self) -> None:
+        """
+        creates the offscreen OpenGL context
+
+        """
+        self._context = gl_context.create_context(self._width, self._height)
+
+    def _init_framebuffer(self) -> None:
+        """
+        creates the framebuffer object the stitched image is rendered into, so no window is needed
 
-        glfw.make_context_current(self._window)
+        """
+        self._framebuffer = glGenFramebuffers(1)
+        glBindFramebuffer(GL_FRAMEBUFFER, self._framebuffer)
+
+        self._color_buffer = glGenRenderbuffers(1)
+        glBindRenderbuffer(GL_RENDERBUFFER, self._color_buffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, self._width, self._height)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self._color_buffer)
+
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise Exception("Framebuffer is incomplete")
+        glViewport(0, 0, self._width, self._height)
+
+    def _init_pixel_buffer(self) -> None:
+        """
+        creates the pixel buffer object the stitched image is read back through
+
+        Each image pair must be answered with its own stitched image (see stitch()), so the read back is
+        synchronous: mapping the buffer waits for the copy out of the framebuffer to finish. Reading through a pixel
+        buffer still lets the image be decoded straight from the mapped memory, without an extra copy
+
+        """
+        self._pixel_buffer = glGenBuffers(1)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self._pixel_buffer)
+        glBufferData(GL_PIXEL_PACK_BUFFER, self._width * self._height * 3, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
 
     def _load_shaders(self) -> None:
         """
@@ -362,20 +342,41 @@ class Stitcher:
 
         self._program = CompiledShader(vert_shader, frag_shader)
 
-    def _start_glfw(self) -> None:
+    def _start_render_loop(self) -> None:
         """
-        Starts and houses the glfw loop
+        Starts and houses the render loop
+
+        Nothing is drawn until stitch() hands over an image pair, and each pair is drawn exactly once
 
         """
-        while not glfw.window_should_close(self._window):
+        self._is_running = True
+        while not self._context.should_close():
+            pending = self._wait_for_images()
+            if self._should_stop:
+                break
+            if pending is None:
+                continue
+
+            request, image_1, image_2 = pending
+            image, error = None, None
             try:
-                glfw.poll_events()
-                self._update_image()
-                glfw.swap_buffers(self._window)
+                image = self._update_image(image_1, image_2)
             except Exception as e:
-                pass
-            time.sleep(0.01)
-        glfw.terminate()
+                error = e
+
+            with self._condition:
+                self._stitched_image = image
+                self._error = error
+                self._finished = request
+                self._condition.notify_all()
+
+        with self._condition:
+            self._is_running = False
+            self._condition.notify_all()
+        glDeleteBuffers(1, [self._pixel_buffer])
+        glDeleteRenderbuffers(1, [self._color_buffer])
+        glDeleteFramebuffers(1, [self._framebuffer])
+        self._context.destroy()
 
     def _draw_string(self, string: str, x: float, y: float, color: tuple) -> None:
         """
@@ -396,72 +397,114 @@ class Stitcher:
             glutBitmapCharacter(GLUT_BITMAP_TIMES_ROMAN_24, ord(char))
         print("String printing is currently not working, since glfw is being used instead of glut.")
 
-    def _save_image(self) -> None:
+    def _save_image(self) -> Image:
         """
-        reads the stitched image from the glfw window and stores it
+        reads the stitched image back through the pixel buffer
+
+        The copy out of the framebuffer runs on the GPU and the frame is decoded straight from the mapped buffer.
+        Mapping waits for the copy to finish, so the image returned is the one just drawn
 
+        Returns:
+            Image: the stitched image, None if it could not be read
         """
         try:
             glPixelStorei(GL_PACK_ALIGNMENT, 1)
-            data = glReadPixels(0, 0, self._width, self._height,
-                                GL_RGB, GL_UNSIGNED_BYTE)
-            image = Image.frombytes("RGB", self._display, data)
-            self._stitched_image = ImageOps.flip(image)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, self._pixel_buffer)
+            glReadPixels(0, 0, self._width, self._height, GL_RGB, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+            return self._map_pixel_buffer()
         except Exception as e:
-            pass
+            return None
+        finally:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
 
-    def _do_stitching(self) -> None:
+    def _map_pixel_buffer(self) -> Image:
         """
-        stitches the two images
+        copies a frame out of the pixel buffer
+
+        The image is decoded straight from the mapped memory, which is the only copy of the frame made on the CPU
 
+        Returns:
+            Image: the frame, None if the buffer could not be mapped
         """
-        if not self._images_should_exist:
-            return
+        size = self._width * self._height * 3
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, self._pixel_buffer)
+        pointer = glMapBufferRange(GL_PIXEL_PACK_BUFFER, 0, size, GL_MAP_READ_BIT)
+        if not pointer:
+            return None
+        try:
+            return Image.frombytes("RGB", self._display, (ctypes.c_ubyte * size).from_address(pointer))
+        finally:
+            glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
 
-        if self._image_1 is None or self._image_2 is None:
-            return
+    def _wait_for_images(self) -> tuple:
+        """
+        waits until an image pair is handed to the render thread
+
+        Returns:
+            tuple: the request number and image pair, None if none arrived before the idle check
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending_images is not None or self._should_stop,
+                                     timeout=IDLE_CHECK_PERIOD)
+            pending = self._pending_images
+            self._pending_images = None
+            return pending
+
+    def _do_stitching(self, image_1: bosdyn.client.image, image_2: bosdyn.client.image) -> None:
+        """
+        stitches the two images
 
-        image_1 = ImagePreppedForOpenGL(self._image_1)
-        image_2 = ImagePreppedForOpenGL(self._image_2)
+        Args:
+            image_1 (bosdyn.client.image): the image from the right camera
+            image_2 (bosdyn.client.image): the image from the left camera
+        """
+        image_1 = self._prepared_images.get(image_1)
+        image_2 = self._prepared_images.get(image_2)
         try:
             draw_routine(self._display, image_1, image_2, self._program)
         except Exception as e:
             pass  # print("OpenGL error?")
 
-    def _update_image(self) -> None:
+    def _update_image(self, image_1: bosdyn.client.image, image_2: bosdyn.client.image) -> Image:
         """
         stitches and saves the image
 
+        Args:
+            image_1 (bosdyn.client.image): the image from the right camera
+            image_2 (bosdyn.client.image): the image from the left camera
+
+        Returns:
+            Image: the stitched image
         """
-        self._is_running = True
         glClearColor(1, 1, 1, 0)
         glClear(GL_COLOR_BUFFER_BIT)
 
-        try:
-            self._do_stitching()
-        except bosdyn.client.frame_helpers.ValidateFrameTreeError:
-            # background_process.output_to_socket(-1, "<red><b>Issue with cameras, robot must be rebooted</b></red>", all=True)
-            pass
-        self._save_image()
+        self._do_stitching(image_1, image_2)
+        return self._save_image()
 
     def stitch(self, image_1: bosdyn.client.image, image_2: bosdyn.client.image) -> Image:
         """
-        updates the program with new images and returns the already stitched image
+        hands the images to the render thread and returns the image stitched from them
 
         Args:
             image_1 (bosdyn.client.image): the image from the right camera
             image_2 (bosdyn.client.image): the image from the left camera
 
         Returns:
-            Image: the stitched image
+            Image: the stitched image, None if the render loop is not running or did not finish in time
         """
-
-        if not self._is_running:
-            return None
-        self._images_should_exist = False
-
-        self._image_1 = image_1
-        self._image_2 = image_2
-
-        self._images_should_exist = True
-        return self._stitched_image
+        with self._condition:
+            if not self._is_running:
+                return None
+            self._requested += 1
+            request = self._requested
+            self._pending_images = (request, image_1, image_2)
+            self._condition.notify_all()
+
+            self._condition.wait_for(lambda: self._finished >= request or not self._is_running,
+                                     timeout=STITCH_TIMEOUT)
+            if self._finished != request:
+                return None
+            if self._error is not None:
+                raise self._error
+            return self._stitched_image
@@ -0,0 +1,232 @@
+"""
+Runs the video feed as a pipeline of stages, each its own task on the event loop
+
+Every stage hands its output to the next stage through a small queue, so the next frame can be fetched while the
+current one is being stitched or encoded. Coroutine stages run on the event loop, and blocking stages run on an
+executor so they never hold up the loop. The frames per second of the whole pipeline is set by its slowest stage.
+When a stage falls behind, the oldest waiting frame is dropped so the video stays live instead of lagging.
+
+Classes:
+
+    Pipeline_Stage
+    Video_Pipeline
+"""
+import asyncio
+import time
+
+from SpotSite.spot_logging import log
+
+# How much a new measurement moves the running averages
+STATS_SMOOTHING = 0.2
+
+
+class Pipeline_Stage:
+    """
+    A single stage of the video pipeline
+
+    A stage without an input queue is a source: it calls its work function repeatedly to produce frames.
+    Every other stage calls its work function on each frame it receives. Returning None from the work function
+    drops the frame. A coroutine work function is awaited on the event loop, any other work function is run on
+    the executor.
+
+    Attributes:
+        name (str): the name of the stage
+        _work (callable): the function run on each frame
+        _is_coroutine (bool): whether the work function is a coroutine function
+        _executor (Executor): runs a blocking work function, None for the loop's default executor
+        _queue_size (int): how many frames can wait for this stage
+        _input (Queue): frames waiting for this stage, None for a source stage
+        _is_source (bool): whether the stage produces frames instead of receiving them
+        _next_stage (Pipeline_Stage): the stage frames are handed to
+        _idle_sleep (float): how long a source stage waits after producing nothing, in seconds
+        _task (Task): the stage task
+        _processed (int): how many frames the stage has finished
+        _dropped (int): how many frames were dropped while waiting for this stage
+        _average_ms (float): the running average time spent on one frame, in milliseconds
+        _average_interval (float): the running average time between finished frames, in seconds
+        _last_finished (float): when the last frame was finished
+
+    Methods:
+        then(stage):
+            Sets the stage frames are handed to
+        start():
+            Starts the stage task
+        stop():
+            Stops the stage task
+        put(frame):
+            Queues a frame for this stage, dropping the oldest waiting frame if the queue is full
+        _run():
+            Houses the stage loop
+        _process(frame):
+            Runs the work function on a frame and hands the result to the next stage
+        get_stats():
+            Returns the throughput and queue depth of the stage
+    """
+
+    def __init__(self, name: str, work: callable, queue_size: int = 1, is_source: bool = False,
+                 idle_sleep: float = 0.01, executor: object = None):
+        self.name = name
+        self._work = work
+        self._is_coroutine = asyncio.iscoroutinefunction(work)
+        self._executor = executor
+        self._queue_size = queue_size
+        self._input = None
+        self._is_source = is_source
+        self._next_stage = None
+        self._idle_sleep = idle_sleep
+
+        self._task = None
+
+        self._processed = 0
+        self._dropped = 0
+        self._average_ms = 0.0
+        self._average_interval = 0.0
+        self._last_finished = None
+
+    def then(self, stage: "Pipeline_Stage") -> "Pipeline_Stage":
+        """
+        Sets the stage frames are handed to
+
+        Args:
+            stage (Pipeline_Stage): the next stage
+
+        Returns:
+            Pipeline_Stage: the next stage, so stages can be chained
+        """
+        self._next_stage = stage
+        return stage
+
+    def start(self) -> None:
+        """
+        Starts the stage task, must be called from the event loop
+        """
+        if not self._is_source:
+            self._input = asyncio.Queue(maxsize=self._queue_size)
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        """
+        Stops the stage task
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def put(self, frame: any) -> None:
+        """
+        Queues a frame for this stage, dropping the oldest waiting frame if the queue is full
+
+        Args:
+            frame (any): the frame
+        """
+        while self._input.full():
+            self._input.get_nowait()
+            self._dropped += 1
+        self._input.put_nowait(frame)
+
+    async def _run(self) -> None:
+        """
+        Houses the stage loop
+        """
+        while True:
+            if self._is_source:
+                if not await self._process(None):
+                    await asyncio.sleep(self._idle_sleep)
+                continue
+            await self._process(await self._input.get())
+
+    async def _process(self, frame: any) -> bool:
+        """
+        Runs the work function on a frame and hands the result to the next stage
+
+        Args:
+            frame (any): the frame, None for a source stage
+
+        Returns:
+            bool: whether the stage produced a frame
+        """
+        args = () if self._is_source else (frame,)
+        start = time.perf_counter()
+        try:
+            if self._is_coroutine:
+                result = await self._work(*args)
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(self._executor, self._work, *args)
+        except Exception as e:
+            log(f"Video stage {self.name} failed: {e}")
+            result = None
+        finished = time.perf_counter()
+
+        if result is None:
+            return False
+
+        self._processed += 1
+        self._average_ms += ((finished - start) * 1000 - self._average_ms) * STATS_SMOOTHING
+        if self._last_finished is not None:
+            self._average_interval += (finished - self._last_finished - self._average_interval) * STATS_SMOOTHING
+        self._last_finished = finished
+
+        if self._next_stage is not None:
+            self._next_stage.put(result)
+        return True
+
+    def get_stats(self) -> dict:
+        """
+        Returns the throughput and queue depth of the stage
+
+        Returns:
+            dict: the stats
+        """
+        return {
+            "name": self.name,
+            "fps": round(1 / self._average_interval, 2) if self._average_interval > 0 else 0,
+            "average_ms": round(self._average_ms, 2),
+            "queue_depth": self._input.qsize() if self._input is not None else 0,
+            "processed": self._processed,
+            "dropped": self._dropped,
+        }
+
+
+class Video_Pipeline:
+    """
+    A chain of pipeline stages started and stopped together
+
+    Attributes:
+        stages (list): the stages, in the order frames pass through them
+
+    Methods:
+        start():
+            Starts every stage
+        stop():
+            Stops every stage
+        get_stats():
+            Returns the stats of every stage
+    """
+
+    def __init__(self, stages: list):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.then(next_stage)
+
+    def start(self) -> None:
+        """
+        Starts every stage, must be called from the event loop
+        """
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self) -> None:
+        """
+        Stops every stage
+        """
+        for stage in self.stages:
+            stage.stop()
+
+    def get_stats(self) -> list:
+        """
+        Returns the stats of every stage
+
+        Returns:
+            list: the stats, in the order frames pass through the stages
+        """
+        return [stage.get_stats() for stage in self.stages]
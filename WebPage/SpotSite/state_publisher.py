@@ -0,0 +1,152 @@
+"""
+Publishes the state of the robot and server to the clients
+
+State is a set of topics, each holding the newest value of something the clients display, ex. the battery
+percentage. A value is only sent when it changes, each topic is sent at most once per its minimum interval, and every
+topic that is due at the same time and published on the same pub/sub topic (see ```websocket.MESSAGE_TOPICS```) is
+bundled into a single "state" message:
+
+    {"type": "state", "output": {topic: value, ...}}
+
+A socket that connects is sent every topic at once, so values that have not changed since are not missing.
+
+Classes:
+
+    State_Publisher
+
+Misc Variables:
+
+    STATE_TOPIC_INTERVALS (dict): the minimum time between two sends of each topic, in seconds
+"""
+import time
+
+from SpotSite.socket_messages import encode_message
+
+# The minimum time between two sends of each topic, in seconds. Topics not listed here use DEFAULT_INTERVAL
+STATE_TOPIC_INTERVALS = {
+    "battery_percentage": 1.0,
+    "battery_runtime": 5.0,
+    "control_mode": 0.1,
+}
+DEFAULT_INTERVAL = 0.1
+
+
+class State_Publisher:
+    """
+    Sends the topics of the state to the clients subscribed to them when they change, no more often than their
+    minimum interval
+
+    Everything except ```publish``` runs on the event loop, so the topics need no lock
+
+    Attributes:
+        _loop (AbstractEventLoop): the event loop the websockets run on
+        _send (callable): publishes a serialized message, called with the message and its pub/sub topics
+        _topic_of (callable): returns the pub/sub topic a topic of the state is published on, None for every socket
+        _values (dict): the newest value of each topic
+        _sent (dict): the last value sent of each topic
+        _last_sent_times (dict): when each topic was last sent
+        _pending (set): the topics whose newest value has not been sent yet
+        _flush_handle (TimerHandle): the scheduled send of the pending topics, None if nothing is scheduled
+
+    Methods:
+        publish(topic, value):
+            Sets the newest value of a topic, from any thread
+        snapshot():
+            Returns the newest value of every topic
+        _set(topic, value):
+            Sets the newest value of a topic and schedules it to be sent
+        _schedule():
+            Schedules the next send for when the first pending topic is due
+        _flush():
+            Sends every pending topic that is due, one message per pub/sub topic
+        _due_time(topic):
+            Returns when a topic may be sent next
+    """
+
+    def __init__(self, loop: object, send: callable, topic_of: callable):
+        self._loop = loop
+        self._send = send
+        self._topic_of = topic_of
+        self._values = {}
+        self._sent = {}
+        self._last_sent_times = {}
+        self._pending = set()
+        self._flush_handle = None
+
+    def publish(self, topic: str, value: any) -> None:
+        """
+        Sets the newest value of a topic, from any thread
+
+        Args:
+            topic (str): the name of the topic, ex. "battery_percentage"
+            value (any): the value, must be json serializable
+        """
+        self._loop.call_soon_threadsafe(self._set, topic, value)
+
+    def snapshot(self) -> dict:
+        """
+        Returns the newest value of every topic, must be called from the event loop
+
+        Returns:
+            dict: the values, by topic
+        """
+        return dict(self._values)
+
+    def _set(self, topic: str, value: any) -> None:
+        """
+        Sets the newest value of a topic and schedules it to be sent
+
+        Args:
+            topic (str): the name of the topic
+            value (any): the value
+        """
+        self._values[topic] = value
+        if topic in self._sent and self._sent[topic] == value:
+            # Changed back before the last change was sent
+            self._pending.discard(topic)
+            return
+        self._pending.add(topic)
+        self._schedule()
+
+    def _schedule(self) -> None:
+        """
+        Schedules the next send for when the first pending topic is due
+        """
+        if self._flush_handle is not None or not self._pending:
+            return
+        delay = max(0.0, min(self._due_time(topic) for topic in self._pending) - time.monotonic())
+        self._flush_handle = self._loop.call_later(delay, self._flush)
+
+    def _flush(self) -> None:
+        """
+        Sends every pending topic that is due, one message per pub/sub topic
+        """
+        self._flush_handle = None
+        now = time.monotonic()
+        bundles = {}
+        for topic in [topic for topic in self._pending if self._due_time(topic) <= now]:
+            value = self._values[topic]
+            bundles.setdefault(self._topic_of(topic), {})[topic] = value
+            self._sent[topic] = value
+            self._last_sent_times[topic] = now
+            self._pending.discard(topic)
+
+        for pub_sub_topic, bundle in bundles.items():
+            self._send(encode_message("state", bundle), (pub_sub_topic,))
+
+        self._schedule()
+
+    def _due_time(self, topic: str) -> float:
+        """
+        Returns when a topic may be sent next
+
+        Args:
+            topic (str): the name of the topic
+
+        Returns:
+            float: the monotonic time
+        """
+        last_sent_time = self._last_sent_times.get(topic)
+        if last_sent_time is None:
+            return 0.0
+        return last_sent_time + STATE_TOPIC_INTERVALS.get(topic, DEFAULT_INTERVAL)
@@ -10,6 +10,8 @@ let socket;
 // Make sure that the socket connection was successful, and tell the client if it was not
 try {
     socket = new WebSocket(href);
+    // Video frames are sent as binary messages, see handle_binary_message
+    socket.binaryType = "arraybuffer";
 } catch (err) {
     addOutput("<red>Error connecting to the server</red>");
 }
@@ -17,21 +19,188 @@ try {
 let socket_index = null;
 let robot_height = 1;
 let robot_is_estopped = false;
+// The version of the command queue shown, null until the whole queue is received
+let command_queue_version = null;
+
+// Binary video frames: a 16 byte header followed by the raw JPEG bytes (see socket_messages.py)
+// kind (uint8) | camera id (uint8) | flags (uint16) | sequence (uint32) | receive timestamp (float64)
+const FRAME_KIND_VIDEO = 1;
+// Large json messages can be sent as a binary message holding the zlib compressed json (see socket_messages.py)
+// kind (uint8) | zlib stream
+const FRAME_KIND_DEFLATE = 2;
+const VIDEO_FRAME_HEADER_SIZE = 16;
+// Video frame flags (see socket_messages.py)
+const VIDEO_FLAG_ROTATION_MASK = 0x3;
+const VIDEO_FLAG_TILE = 0x4;
+// The order must match CAMERA_IDS in socket_messages.py
+const CAMERA_NAMES = ["front", "back", "left", "right", "frontleft", "frontright"];
+// The object url and newest sequence number shown for each camera
+const video_frame_urls = {};
+const video_frame_sequences = {};
+
+// Decodes a binary video frame and shows it in the <img> with the id of the camera name
+function handle_video_frame(buffer) {
+    const header = new DataView(buffer, 0, VIDEO_FRAME_HEADER_SIZE);
+    const camera_name = CAMERA_NAMES[header.getUint8(1)];
+    const sequence = header.getUint32(4);
+    const flags = header.getUint16(2);
+    const capture_time_ms = header.getFloat64(8) * 1000;
+
+    // Frames can arrive out of order after a reconnect, older frames are thrown away.
+    // The sequence number wraps at 2^32, so a large backwards jump is a wrap, not an old frame
+    const last_sequence = video_frame_sequences[camera_name];
+    if (last_sequence !== undefined && sequence <= last_sequence && last_sequence - sequence < 2 ** 31)
+        return;
+    video_frame_sequences[camera_name] = sequence;
+
+    const image = new Blob([new Uint8Array(buffer, VIDEO_FRAME_HEADER_SIZE)], { type: "image/jpeg" });
+    // A raw front image can be a tile of the front view and be shown on its own at the same time
+    if (flags & VIDEO_FLAG_TILE) {
+        show_video_tile(image, flags, capture_time_ms);
+        if (!$("#" + camera_name).length)
+            return;
+    }
+
+    const url = URL.createObjectURL(image);
+    $("#" + camera_name + "-tiles").hide();
+    $("#" + camera_name).show().attr("src", url).attr("data-capture-time", capture_time_ms);
+
+    if (video_frame_urls[camera_name])
+        URL.revokeObjectURL(video_frame_urls[camera_name]);
+    video_frame_urls[camera_name] = url;
+}
+
+// Draws an image that is one tile of another camera's view onto that view's canvas.
+// The server sends these untouched, so the rotation and side by side layout happen here instead
+function show_video_tile(image, flags, capture_time_ms) {
+    const quarter_turns = flags & VIDEO_FLAG_ROTATION_MASK;
+    const tile = (flags >> 4) & 0x3;
+    const tiles = ((flags >> 6) & 0x3) + 1;
+    const camera_name = CAMERA_NAMES[(flags >> 8) & 0xF];
+
+    createImageBitmap(image).then((bitmap) => {
+        const canvas = video_tile_canvas(camera_name);
+        const sideways = quarter_turns % 2 == 1;
+        const tile_width = sideways ? bitmap.height : bitmap.width;
+        const tile_height = sideways ? bitmap.width : bitmap.height;
+
+        // Resizing a canvas clears it, so it is only resized when the tiles change size
+        if (canvas.width != tile_width * tiles || canvas.height != tile_height) {
+            canvas.width = tile_width * tiles;
+            canvas.height = tile_height;
+        }
+
+        const context = canvas.getContext("2d");
+        context.save();
+        context.translate((tile + 0.5) * tile_width, tile_height / 2);
+        context.rotate(quarter_turns * Math.PI / 2);
+        context.drawImage(bitmap, -bitmap.width / 2, -bitmap.height / 2);
+        context.restore();
+        bitmap.close();
+
+        $(canvas).attr("data-capture-time", capture_time_ms);
+    }).catch((error) => console.log("Unable to decode video tile: ", error));
+}
+
+// Returns the canvas tiles of a camera's view are drawn on, and shows it in place of the camera's <img>
+function video_tile_canvas(camera_name) {
+    let canvas = $("#" + camera_name + "-tiles");
+    if (!canvas.length) {
+        canvas = $("<canvas>").attr("id", camera_name + "-tiles").addClass("video-tiles");
+        $("#" + camera_name).after(canvas);
+    }
+    $("#" + camera_name).hide();
+    return canvas.show()[0];
+}
+
+// Subscribes to the video of every camera with an <img> on the page and to the battery, and unsubscribes from them
+// while the page is hidden so the server does not fetch images nobody is looking at. The other topics (the log,
+// command queue, estop and scratch clients) stay subscribed, see TOPICS in websocket.py
+function update_subscriptions() {
+    const topics = CAMERA_NAMES
+        .filter((camera_name) => $("#" + camera_name).length)
+        .map((camera_name) => "video/" + camera_name);
+    topics.push("battery");
+    socket.send(
+        JSON.stringify({
+            action: document.hidden ? "unsubscribe" : "subscribe",
+            topics: topics,
+        })
+    );
+}
+
+document.addEventListener("visibilitychange", () => {
+    if (socket.readyState == WebSocket.OPEN)
+        update_subscriptions();
+});
+
+// Handles binary messages from the server, the first byte of the message specifies its kind
+function handle_binary_message(buffer) {
+    const kind = new DataView(buffer).getUint8(0);
+    if (kind == FRAME_KIND_VIDEO)
+        handle_video_frame(buffer);
+    else if (kind == FRAME_KIND_DEFLATE)
+        queue_json_message(inflate_message(buffer));
+    else
+        console.log("Binary message kind not recognized: ", kind);
+}
+
+// Tells the server which compressed messages this browser can inflate
+socket.onopen = () => {
+    socket.send(
+        JSON.stringify({
+            action: "hello",
+            compression: "DecompressionStream" in window ? ["deflate"] : [],
+        })
+    );
+};
 
 // Handles socket messages from the server
 socket.onmessage = (message) => {
-    // Parses the JSON
-    const data = JSON.parse(message["data"]);
+    if (message["data"] instanceof ArrayBuffer)
+        return handle_binary_message(message["data"]);
+
+    queue_json_message(message["data"]);
+};
+
+// Json messages are handled one at a time in the order they arrived, so a message that is still being inflated
+// is not overtaken by the messages after it
+let json_messages = Promise.resolve();
+function queue_json_message(text) {
+    json_messages = json_messages
+        .then(() => text)
+        .then((text) => handle_message(JSON.parse(text)))
+        .catch((err) => console.log("Failed to handle message: ", err));
+}
+
+// Inflates a compressed json message, resolves to the json text
+function inflate_message(buffer) {
+    const stream = new Blob([new Uint8Array(buffer, 1)]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Response(stream).text();
+}
+
+// Handles a json message from the server with the handler for its type
+function handle_message(data) {
+    const handler = message_handlers[data["type"]];
+
+    // Handles unknown output types (should not happen, just for safetey and potential debugging) 
+    if (handler === undefined)
+        return addOutput("<red>Type not recognized: " + data["type"] + "</red>");
+    handler(data);
+}
 
+// The handler of each type of json message, by type
+const message_handlers = {
     // Ensures that the socket connection was successful and stores its index for future use
-    if (data["type"] == "socket_create") {
+    socket_create: (data) => {
         socket_index = data["socket_index"];
         addOutput(
             "Successfully connected to the server at <green>socket index " + socket_index + "</green>"
         );
-    }
+        update_subscriptions();
+    },
     // Updates the yellow text that tells whether or not the background process is running
-    else if (data["type"] == "bg_process") {
+    bg_process: (data) => {
         if (data["output"] == "start") {
             $("#isRunning").html("Background process is running");
             robot_is_estopped = false;
@@ -44,9 +213,9 @@ socket.onmessage = (message) => {
         }
         else
             $("#isRunning").html("Background process is not running");
-    }
+    },
     // Updates the estop button. Useful if multiple clients are active
-    else if (data["type"] == "estop") {
+    estop: (data) => {
         if (data["output"] == "estop") {
             robot_is_estopped = true;
             $("#estop").html("Release Estop");
@@ -65,26 +234,20 @@ socket.onmessage = (message) => {
                 cursor: "pointer",
             });
         }
-    }
+    },
     // Handles the message containing the program list
-    else if (data["type"] == "programs") {
+    programs: (data) => {
         $(".program-list").html("");
         program_handler.programs = data["output"];
         program_handler.show_programs();
-    }
-    // Handles video feed, the prefix @ specifies that the message is an image in the video feed
-    else if (data["type"][0] == "@") {
-        const image = data["output"];
-        const image_name = data["type"].substring(1, data["type"].length);
-        $("#" + image_name).attr("src", "data:image/jpeg;base64," + image);
-    }
+    },
     // Updates the keyboard control mode (Walk/Stand)
-    else if (data["type"] == "control_mode") {
+    control_mode: (data) => {
         const mode = data["output"];
         $("#space").html(mode + " Mode");
-    }
+    },
     // Updates the battery percentage
-    else if (data["type"] == "battery_percentage") {
+    battery_percentage: (data) => {
         const percentage = data["output"];
         $("#b_p").html(percentage + "%");
         // Specifies the color of the battery icon
@@ -93,15 +256,15 @@ socket.onmessage = (message) => {
             'width': (percentage + "%"),
             'background-color': c
         })
-    }
+    },
     // Updates the battery runtime
-    else if (data["type"] == "battery_runtime") {
+    battery_runtime: (data) => {
         const runtime = data["output"];
         const runtime_minutes = Math.round(runtime / 60); // Runtime is given in seconds, convert to minutes
         $("#b_r").html(runtime_minutes + " minutes");
-    }
+    },
     // Updates whether the server is accepting commands or not
-    else if (data["type"] == "toggle_accept_command") {
+    toggle_accept_command: (data) => {
         const is_accepting_commands = data["output"];
         if (is_accepting_commands) {
             $("#toggle-accept-command-button").addClass("option-true");
@@ -109,35 +272,35 @@ socket.onmessage = (message) => {
         else {
             $("#toggle-accept-command-button").removeClass("option-true");
         }
-    }
+    },
     // Updates whether the robot is connected, and which action can be taken as a result
-    else if (data["type"] == "robot_toggle") {
+    robot_toggle: (data) => {
         const state = data["output"];
 
         if (state == "clear")
             $("#connectRobot").html("Connect to Robot")
         else
             $("#connectRobot").html("Disconnect Robot")
-    }
+    },
     // Updates whether the estop is accquired, and which action can be taken as a result
-    else if (data["type"] == "estop_toggle") {
+    estop_toggle: (data) => {
         const state = data["output"];
 
         if (state == "clear")
             $("#getEstop").html("Acquire Estop")
         else
             $("#getEstop").html("Clear Estop")
-    }
+    },
     // Updates whether the lease is accquired, and which action can be taken as a result
-    else if (data["type"] == "lease_toggle") {
+    lease_toggle: (data) => {
         const state = data["output"];
 
         if (state == "clear")
             $("#getLease").html("Acquire Lease")
         else
             $("#getLease").html("Clear Lease")
-    }
-    else if (data["type"] == "toggle_auto_run") {
+    },
+    toggle_auto_run: (data) => {
         const will_auto_run = data["output"];
 
         if (will_auto_run) {
@@ -146,25 +309,49 @@ socket.onmessage = (message) => {
         else {
             $("#toggle-auto-run-commands").removeClass("option-true");
         }
-    }
+    },
+    // Answers the heartbeat of the server, which closes sockets that stop answering
+    ping: (data) => {
+        socket.send(JSON.stringify({ action: "pong" }));
+    },
     // General output
-    else if (data["type"] == "output") {
+    output: (data) => {
         addOutput(data["output"]);
-    }
-    else if (data["type"] == "command_queue") {
-        const command_queue = JSON.parse(data["output"]);
+    },
+    // Applies a change to the command queue, or replaces it with the whole queue (see SpotSite/command_queue.py)
+    command_queue: (data) => {
+        const update = data["output"];
         const command_queue_div = $("#command-queue");
-        command_queue_div.html("");
-        command_queue.forEach(command => {
-            command_queue_div.html(command_queue_div.html() + program_handler.display_command(command));
-        })
-    }
-    else if (data["type"] == "client-list") {
+
+        if (update["op"] == "snapshot") {
+            command_queue_div.html("");
+            update["commands"].forEach(command => show_queued_command(command));
+            command_queue_version = update["version"];
+            return;
+        }
+        // The whole queue is on its way, or the change is already part of the queue shown
+        if (command_queue_version === null || update["version"] <= command_queue_version)
+            return;
+        // A change was missed, so the queue shown is out of date
+        if (update["version"] != command_queue_version + 1) {
+            command_queue_version = null;
+            socket.send(JSON.stringify({ action: "command_queue_snapshot" }));
+            return;
+        }
+
+        if (update["op"] == "append")
+            show_queued_command(update["command"]);
+        else if (update["op"] == "pop")
+            command_queue_div.children().first().remove();
+        else if (update["op"] == "clear")
+            command_queue_div.html("");
+        command_queue_version = update["version"];
+    },
+    "client-list": (data) => {
         update_client_list(data["output"]);
         
-    }
-
-    else if (data["type"] == "scratch_clients") {
+    },
+    scratch_clients: (data) => {
         update_client_list(data["output"][0]);
         const scratch_controller = data["output"][1];
         if (scratch_controller[1] == "-1")
@@ -172,20 +359,30 @@ socket.onmessage = (message) => {
         else
             document.querySelector("#ip-" + scratch_controller[1].replaceAll(".", "-")).classList.add("chosen");
         document.querySelector("#scratch-controller-name").innerHTML = scratch_controller[0];
-    }
-
-    else if (data["type"] == "robot_height") {
+    },
+    robot_height: (data) => {
         robot_height = round(parseFloat(data["output"]));
 
         console.log("Robot height: ", robot_height);
-    }
-
-    // Handles unknown output types (should not happen, just for safetey and potential debugging) 
-    else {
-        addOutput("<red>Type not recognized: " + data["type"] + "</red>");
-    }
+    },
+    // Handles several messages the server sent together, in order
+    batch: (data) => {
+        data["output"].forEach((message) => handle_message(message));
+    },
+    // Handles a bundle of state topics (battery, control mode...) that changed on the server.
+    // Each topic is handled as if it was its own message
+    state: (data) => {
+        const state = data["output"];
+        for (const topic in state)
+            handle_message({ type: topic, output: state[topic] });
+    },
 };
 
+// Adds a command to the end of the command queue shown
+function show_queued_command(command) {
+    $("#command-queue").append($("<span>").html(program_handler.display_command(command)));
+}
+
 /*
 Lets the client know when the socket has closed
 - Displays after a delay because simply reloading the page, and there is
@@ -8,6 +8,7 @@ from pathlib import Path
 import bosdyn
 
 from SpotSite import websocket
+from SpotSite.socket_messages import encode_video_frame, encode_video_renditions
 from SpotSite.spot_logging import log
 
 
@@ -46,6 +47,96 @@ def output_to_socket(socket_index: any, message: str, all: bool = False, type: s
         socket_index, message, all=all, type=type)
 
 
+def publish_state(topic: str, value: any):
+    """
+    Sets the newest value of a state topic, which is sent to all sockets when it changes
+
+    Args:
+        topic (str): the name of the topic, ex. "battery_percentage"
+        value (any): the value, must be json serializable
+    """
+    websocket.websocket_list.state.publish(topic, value)
+
+
+def output_frame_to_socket(camera_name: str, image: bytes, sequence: int, timestamp: float, flags: int = 0):
+    """
+    Outputs a JPEG image from a camera to all sockets as a binary video frame
+
+    Args:
+        camera_name (str): the name of the camera (see ```socket_messages.CAMERA_IDS```)
+        image (bytes): the JPEG encoded image
+        sequence (int): the sequence number of the image for the camera
+        timestamp (float): the time the server received the image from the robot, in seconds since the epoch
+        flags (int, optional): how the client shows the image (see ```socket_messages.video_frame_flags```).
+            Defaults to 0.
+    """
+    websocket.websocket_list.print_message(
+        -1, encode_video_frame(camera_name, image, sequence, timestamp, flags), all=True)
+
+
+def output_renditions_to_socket(camera_name: str, images: dict, sequence: int, timestamp: float, flags: int = 0):
+    """
+    Outputs every rendition of a frame from a camera to all sockets, each socket sends the one it can keep up with
+
+    Args:
+        images (dict): the JPEG encoded image at each rendition level
+
+    see ```output_frame_to_socket``` for other argument information
+    """
+    websocket.websocket_list.print_message(
+        -1, encode_video_renditions(camera_name, images, sequence, timestamp, flags), all=True)
+
+
+def get_event_loop() -> object:
+    """
+    Returns the event loop the websockets run on
+
+    Returns:
+        AbstractEventLoop: the event loop
+    """
+    return websocket.websocket_list.loop
+
+
+def get_subscribed_cameras() -> set:
+    """
+    Returns every camera at least one socket subscribed to
+
+    Returns:
+        set: the names of the cameras
+    """
+    return websocket.websocket_list.get_subscribed_cameras()
+
+
+def get_video_rendition_levels() -> set:
+    """
+    Returns the video rendition levels the sockets currently want
+
+    Returns:
+        set: the rendition levels
+    """
+    return websocket.websocket_list.get_rendition_levels()
+
+
+def get_socket_video_stats() -> dict:
+    """
+    Returns the video quality of each socket
+
+    Returns:
+        dict: the stats of each socket, by socket index
+    """
+    return websocket.websocket_list.get_video_stats()
+
+
+def get_socket_stats() -> dict:
+    """
+    Returns how many sockets are open and how many were reaped by the heartbeat
+
+    Returns:
+        dict: the stats
+    """
+    return websocket.websocket_list.get_socket_stats()
+
+
 def print_exception(socket_index: any):
     """
     Prints an exception with relevant information to a given socket
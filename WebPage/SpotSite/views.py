@@ -33,10 +33,17 @@ Functions:
     get_server_state(request) -> JsonResponse
     get_internal_state(request) -> JsonResponse
     get_keyboard_control_state(request) -> JsonResponse
+    camera_stream(request, camera_name) -> StreamingHttpResponse
     websocket_view(object)
+
+Misc Variables:
+
+    MJPEG_BOUNDARY (str): the boundary between the frames of a camera stream
+    MJPEG_FRAME_TIMEOUT (float): how long a camera stream waits for a frame before it ends, in seconds
+    MJPEG_MAX_STREAM_SECONDS (float): how long a camera stream lasts at most, in seconds
 """
 
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.core.files.storage import default_storage
 from django.core.files.base import ContentFile
 
@@ -44,10 +51,23 @@ from SpotSite import action_handling, background_process
 from SpotSite import websocket
 from SpotSite.spot_logging import log
 from SpotSite.scratch_handling import scratch_handler
+from SpotSite.socket_messages import CAMERA_IDS
 
 import pathlib
 import json
 import os
+import time
+
+MJPEG_BOUNDARY = "frame"
+
+# How long a camera stream waits for a frame before it ends, in seconds. No frame for this long means the camera is
+# not being fetched anymore, ex. the robot was disconnected
+MJPEG_FRAME_TIMEOUT = 5
+
+# Django before 5.0 does not stop a streaming response when its client disconnects, and a stream keeps its camera
+# fetched, so a stream nobody watches would never end. Every stream ends after this long, and players reconnect to
+# keep watching
+MJPEG_MAX_STREAM_SECONDS = 600
 
 # Renders the main site
 
@@ -530,8 +550,7 @@ def get_keyboard_control_state(request: HttpRequest) -> JsonResponse:
 
 
 def clear_queue(request: HttpRequest) -> JsonResponse:
-    background_process.bg_process.command_queue = []
-    background_process.bg_process._update_command_queue()
+    background_process.bg_process.command_queue.clear()
 
     return JsonResponse({}, status=200)
 
@@ -575,6 +594,67 @@ def set_robot_height(request: HttpRequest) -> JsonResponse:
     }, status=200)
 
 
+async def camera_stream(request: HttpRequest, camera_name: str) -> HttpResponse:
+    """
+    Streams a camera as MJPEG (multipart/x-mixed-replace), which an <img> tag, VLC or ffmpeg can play directly
+
+    The frames are read from the frame buffer the video loop already fills, so a stream does not request images
+    from the robot on its own. The camera is fetched for as long as at least one stream reads it
+
+    Args:
+        request (HttpRequest): the request
+        camera_name (str): the name of the camera (see ```socket_messages.CAMERA_IDS```)
+
+    Returns:
+        HttpResponse: the stream, or a 404 JsonResponse listing the cameras if the camera is not known
+    """
+    if camera_name not in CAMERA_IDS:
+        return JsonResponse({
+            "valid": False,
+            "cameras": list(CAMERA_IDS)
+        }, status=404)
+
+    response = StreamingHttpResponse(_mjpeg_frames(camera_name),
+                                     content_type=f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}")
+    # Every part replaces the last one, so there is nothing worth storing
+    response["Cache-Control"] = "no-cache, no-store"
+    # Stops reverse proxies from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def _mjpeg_frames(camera_name: str):
+    """
+    Yields the parts of an MJPEG stream, one for each new frame of a camera
+
+    The stream ends when no frame arrives for MJPEG_FRAME_TIMEOUT, or after MJPEG_MAX_STREAM_SECONDS. The camera
+    reader is released when the stream ends, including when the server cancels it because the client disconnected
+
+    Args:
+        camera_name (str): the name of the camera
+
+    Yields:
+        bytes: the parts of the stream
+    """
+    frame_buffer = background_process.bg_process.image_handler.frame_buffer
+    # The reader is registered for the life of the with block, which releases it however the stream ends
+    with frame_buffer.reader(camera_name):
+        sequence = None
+        deadline = time.monotonic() + MJPEG_MAX_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            frame = await frame_buffer.wait_for_frame(camera_name, sequence, timeout=MJPEG_FRAME_TIMEOUT)
+            if frame is None:
+                return
+            sequence = frame.sequence
+            yield (f"--{MJPEG_BOUNDARY}\r\n"
+                   f"Content-Type: image/jpeg\r\n"
+                   f"Content-Length: {len(frame.data)}\r\n"
+                   f"X-Timestamp: {frame.timestamp:.3f}\r\n\r\n").encode()
+            # The frame is shared with every other reader. Django passes bytes through, but would copy a memoryview
+            yield frame.data
+            yield b"\r\n"
+
+
 async def websocket_view(socket: object) -> None:
     """
     Handles new websockets and adds them to a list of active sockets. Then keeps the socket alive forever (until it closes itself)
@@ -582,16 +662,12 @@ async def websocket_view(socket: object) -> None:
     Args:
         socket (object): the websocket object
     """
-    socket_index = websocket.websocket_list.add_socket(socket)
+    connection = websocket.websocket_list.add_socket(socket)
 
-    await socket.accept()
-    await socket.send_json({
-        'type': "socket_create",
-        'socket_index': socket_index
-    })
-    log(f"New websocket connection: {socket_index}")
-    background_process.bg_process._update_command_queue()
-    await websocket.websocket_list.sockets[socket_index].keep_alive()
+    await connection.open()
+    log(f"New websocket connection: {connection.index}")
+    background_process.bg_process.send_command_queue_snapshot(connection.index)
+    await connection.keep_alive()
 
 
 async def scratch_websocket(socket: object) -> None:
@@ -8,21 +8,79 @@ Classes:
     
 Functions:
 
+    expand_topics(topics) -> frozenset
     close_all_sockets()
     
 Misc Variables:
 
     websocket_list (Websocket_list): the list to hold the websockets
+    MAX_QUEUED_CONTROL_MESSAGES (int): how many control messages a socket can fall behind before it is closed
+    COALESCED_TYPES (set): message types where only the newest waiting message is sent
+    MESSAGE_TOPICS (dict): the topic each type of message is published on
+    TOPICS (frozenset): every topic a client can subscribe to
+    DEFAULT_TOPICS (frozenset): the topics a socket is subscribed to when it connects
+    BATCH_WINDOW (float): how long a socket waits for more control messages before it sends them, in seconds
+    MAX_BATCH_MESSAGES (int): the most control messages sent in one batch
+    HEARTBEAT_INTERVAL (float): how often every socket is pinged, in seconds, unless set in config.json
+    HEARTBEAT_TIMEOUT (float): how long a socket can go without sending anything before it is reaped, in seconds,
+        unless set in config.json
 """
 import asyncio
+import collections
 import json
 import time
 import sys
 import os
 import inspect
+import itertools
+import weakref
 from threading import Thread
 from SpotSite import background_process
 from SpotSite.spot_logging import log
+from SpotSite.socket_messages import Outbound_Message, encode_message, CAMERA_IDS, COMPRESSION_THRESHOLD
+from SpotSite.adaptive_video import Video_Rate_Control
+from SpotSite.state_publisher import State_Publisher
+
+# Control messages are never dropped, so a client that falls this far behind is closed instead
+MAX_QUEUED_CONTROL_MESSAGES = 1000
+
+# Control messages that are queued together, ex. the burst of outputs and toggles while connecting to the robot, are
+# sent as one "batch" message. A socket waits this long for the rest of a burst before sending
+BATCH_WINDOW = 0.005
+MAX_BATCH_MESSAGES = 100
+
+# Each of these messages replaces the last one, so when several are waiting to be dispatched to the same sockets
+# only the newest is sent
+COALESCED_TYPES = {
+    "scratch_clients",
+    "robot_height",
+}
+
+# The topic each type of message is published on. A socket only receives the topics it subscribed to. Types without
+# a topic, ex. "bg_process" or "robot_toggle", are sent to every socket, and so is any message sent to one socket
+MESSAGE_TOPICS = {
+    "output": "log",
+    "battery_percentage": "battery",
+    "battery_runtime": "battery",
+    "command_queue": "command_queue",
+    "scratch_clients": "scratch_clients",
+    "estop": "estop",
+    "estop_toggle": "estop",
+}
+# Video frames are published on the topic of their camera, ex. "video/back". "video/*" stands for every camera
+VIDEO_TOPIC_PREFIX = "video/"
+VIDEO_WILDCARD_TOPIC = VIDEO_TOPIC_PREFIX + "*"
+TOPICS = frozenset(MESSAGE_TOPICS.values()) | frozenset(VIDEO_TOPIC_PREFIX + camera for camera in CAMERA_IDS)
+DEFAULT_TOPICS = frozenset(MESSAGE_TOPICS.values())
+
+# Every socket is pinged this often and answers with a pong. A socket that sends nothing, not even a pong, for the
+# timeout is closed and removed, so no more video is sent to a client that went away without closing its socket.
+# Both can be set in the "websocket" section of config.json
+HEARTBEAT_INTERVAL = 5.0
+HEARTBEAT_TIMEOUT = 15.0
+# How many of the most recently reaped sockets are kept in the socket stats
+REAPED_HISTORY = 20
+
 
 class Websocket:
     """
@@ -33,14 +91,42 @@ class Websocket:
         alive(bool): Whether the socket should be alive
         list(Websocket_List): the websocket list
         index(int): the index (or id) of the websocket
+        video_rate(Video_Rate_Control): chooses the size and frame rate of the video sent to the client
+        compression(bool): whether the client can inflate compressed messages, set by its "hello" action
+        last_seen(float): the monotonic time the client last sent a message, ex. a pong
+        topics(frozenset): the topics the client subscribed to, only messages published on them are sent
+        cameras(frozenset): the cameras whose video topic the client subscribed to. Both are replaced instead of
+            changed, so other threads can read them safely
+        _control_messages(deque): queued messages that must all be delivered, in order
+        _video_messages(dict): the newest queued video frame for each camera. A newer frame replaces an unsent one
+        _has_messages(Event): set when a message is queued
+        _writer(Task): the task sending queued messages to the client
         
     Methods:
         open():
-            Opens the websocket
+            Opens the websocket and starts sending queued messages
         close():
             Closes the socket
         keep_alive():
             Keeps the socket alive
+        subscribe(topics):
+            Starts sending the messages published on topics to the client
+        unsubscribe(topics):
+            Stops sending the messages published on topics to the client
+        _set_topics(topics):
+            Replaces the topics of the client and the cameras they include
+        enqueue(message):
+            Queues an already serialized message to be sent to the client
+        _write_messages():
+            Sends queued messages to the client until the socket closes
+        _next_message():
+            Takes the next message to send, batching the queued control messages
+        _is_batchable(message):
+            Returns whether a control message can join a batch
+        _stop_writer():
+            Stops sending queued messages
+        send(message):
+            Sends an already serialized message to the client
         set_socket(socket):
             Sets the socket passed from the client
         
@@ -50,14 +136,34 @@ class Websocket:
         self.alive = True
         self.list = socket_list
         self.index = index
+        self.video_rate = Video_Rate_Control()
+        self.compression = False
+        self.last_seen = time.monotonic()
+        self.topics = frozenset()
+        self.cameras = frozenset()
+
+        self._control_messages = collections.deque()
+        self._video_messages = {}
+        self._has_messages = asyncio.Event()
+        self._writer = None
 
     async def open(self) -> None:
         """
-        Opens the websocket
-        
+        Opens the websocket and starts sending queued messages
+
+        The socket index is the first message the client receives, followed by the current state
         """
         await self.socket.accept()
-        
+        self._control_messages.appendleft(Outbound_Message("socket_create", json.dumps({
+            'type': "socket_create",
+            'socket_index': self.index
+        })))
+        state = self.list.state.snapshot()
+        if state:
+            self._control_messages.insert(1, encode_message("state", state))
+        self._has_messages.set()
+        self._writer = asyncio.ensure_future(self._write_messages())
+
     async def close(self) -> None:
         """
         Closes the socket
@@ -72,22 +178,41 @@ class Websocket:
         Raises:
             RuntimeError: raised if issues with the websocket arise
         """
+        try:
+            await self._receive_messages()
+        finally:
+            log(f"Socket closed: {self.index}")
+            self._stop_writer()
+
+            # Removes itself from the list of sockets so that the list does not get arbitrarily long if many devices are connecting
+            # and disconnecting
+            self.list.remove_key(self.index)
+
+    async def _receive_messages(self) -> None:
+        """
+        Handles messages from the client until it disconnects
+
+        Raises:
+            RuntimeError: raised if the client sends an action that is not recognized
+        """
         while self.alive:
             """
-            The program relies on a command being sent from the client when
-                the webpage closes but this command is inconsistent based on what device is being used.
-                The socket is removed from the list of active sockets if an error occurs
-
-            TODO: Fix the issue in a better way. This is more of a temporary fix but might just stay because it's
-                not worth the effort to figure it out. This works.
+            The client sends an "unload" action when the webpage closes, but not every device sends it. A client
+                that leaves without it stops answering the heartbeat pings and is reaped (see
+                ```Websocket_List._run_heartbeat```), and the socket is removed if an error occurs
             """
             newMessage = await self.socket.receive_text()
             if newMessage == "Disconnected":
                 break
+            self.last_seen = time.monotonic()
             message = json.loads(newMessage)
             if message:
                 if message['action'] == "unload":
                     self.alive = False
+                elif message['action'] == 'pong':
+                    pass
+                elif message['action'] == 'hello':
+                    self.compression = "deflate" in message.get('compression', ())
                 elif message['action'] == 'keys':
                     keys = (message['keys_down'], message['keys_up'])
                     websocket_list.keys(keys, self.index)
@@ -95,14 +220,189 @@ class Websocket:
                     websocket_list.start_keyboard_control(self.index)
                 elif message['action'] == 'keyboard_control_release':
                     websocket_list.release_keyboard_control(self.index)
+                elif message['action'] == 'subscribe':
+                    self.subscribe(message['topics'])
+                elif message['action'] == 'unsubscribe':
+                    self.unsubscribe(message['topics'])
+                elif message['action'] == 'command_queue_snapshot':
+                    background_process.bg_process.send_command_queue_snapshot(self.index)
                 else:
                     raise RuntimeError(
                         f"Action {message['action']} not recognized.")
-        log(f"Socket closed: {self.index}")
 
-        # Removes itself from the list of sockets so that the list does not get arbitrarily long if many devices are connecting
-        # and disconnecting
-        self.list.remove_key(self.index)
+    def subscribe(self, topics: list) -> None:
+        """
+        Starts sending the messages published on topics to the client
+
+        The video loop only fetches the cameras at least one client subscribed to. The client is sent the current
+        value of the state and command queue topics it just subscribed to
+
+        Args:
+            topics (list): the topics (see ```TOPICS```). "video/front" is the stitched front view, "video/frontleft"
+                and "video/frontright" are the raw front fisheye images
+        """
+        topics = expand_topics(topics)
+        unknown = topics - TOPICS
+        if unknown:
+            log(f"Socket {self.index} subscribed to unknown topics: {sorted(unknown)}")
+        added = (topics & TOPICS) - self.topics
+        if not added:
+            return
+        self._set_topics(self.topics | added)
+        self.list.on_subscribed(self, added)
+
+    def unsubscribe(self, topics: list) -> None:
+        """
+        Stops sending the messages published on topics to the client
+
+        Args:
+            topics (list): the topics
+        """
+        removed = expand_topics(topics) & self.topics
+        if not removed:
+            return
+        self._set_topics(self.topics - removed)
+        # A tile is queued under its own camera but also published on the topic of its view, so every queued frame
+        # the client no longer has a topic of is dropped, not only the ones of the removed cameras
+        for key in [key for key, message in self._video_messages.items()
+                    if self.topics.isdisjoint(self.list.topics_of(message))]:
+            del self._video_messages[key]
+
+    def _set_topics(self, topics: frozenset) -> None:
+        """
+        Replaces the topics of the client and the cameras they include
+
+        Args:
+            topics (frozenset): the topics
+        """
+        self.list.update_subscribers(self.index, self.topics, topics)
+        self.topics = topics
+        self.cameras = frozenset(topic[len(VIDEO_TOPIC_PREFIX):] for topic in topics
+                                 if topic.startswith(VIDEO_TOPIC_PREFIX))
+
+    def enqueue(self, message: Outbound_Message) -> None:
+        """
+        Queues an already serialized message to be sent to the client
+
+        Video frames only keep the newest frame for each camera, so a slow client skips frames instead of falling
+        behind, and the rendition and frame rate of the video are chosen by ```video_rate```. Every other message
+        is delivered in order and never dropped. Which messages reach this method is decided by the topics the
+        client subscribed to, see ```Websocket_List.publish```
+
+        Must be called from the event loop
+
+        Args:
+            message (Outbound_Message): the message
+        """
+        if not self.alive:
+            return
+        if message.is_video:
+            message = self.video_rate.accept(message, len(self._control_messages))
+            if message is None:
+                return
+            if message.type in self._video_messages:
+                self.video_rate.on_skipped()
+            self._video_messages[message.type] = message
+        else:
+            if len(self._control_messages) >= MAX_QUEUED_CONTROL_MESSAGES:
+                log(f"Socket {self.index} fell too far behind, closing it")
+                self.alive = False
+                self._stop_writer()
+                asyncio.ensure_future(self.close())
+                return
+            self._control_messages.append(message)
+        self._has_messages.set()
+
+    async def _write_messages(self) -> None:
+        """
+        Sends queued messages to the client until the socket closes
+
+        Control messages are sent before video frames so that a stream of frames cannot delay them
+        """
+        while self.alive:
+            await self._has_messages.wait()
+            self._has_messages.clear()
+            if self._control_messages:
+                # Gives the rest of a burst of control messages the chance to join the batch
+                await asyncio.sleep(BATCH_WINDOW)
+            while self.alive and (self._control_messages or self._video_messages):
+                message = self._next_message()
+                try:
+                    start = time.perf_counter()
+                    await self.send(message)
+                    if message.is_video:
+                        self.video_rate.on_sent(message, time.perf_counter() - start)
+                except Exception as e:
+                    if str(e) != "Unexpected ASGI message 'websocket.send', after sending 'websocket.close'.":
+                        log(f"Failed to send {message.type} to socket {self.index}: {e}")
+                    self.alive = False
+
+    def _next_message(self) -> Outbound_Message:
+        """
+        Takes the next message to send, batching the queued control messages
+
+        Queued json control messages are sent as one message, {"type": "batch", "output": [message, ...]}, which is
+        built by joining the already serialized messages instead of serializing them again. Messages long enough to
+        be compressed are sent on their own, so every socket sends the one compressed copy the message caches instead
+        of compressing its own batch
+
+        Returns:
+            Outbound_Message: the message
+        """
+        if not self._control_messages:
+            return self._video_messages.pop(next(iter(self._video_messages)))
+
+        batch = []
+        while self._control_messages and len(batch) < MAX_BATCH_MESSAGES and self._is_batchable(
+                self._control_messages[0]):
+            batch.append(self._control_messages.popleft())
+        if len(batch) == 1:
+            return batch[0]
+        if not batch:
+            return self._control_messages.popleft()
+        return Outbound_Message("batch", '{"type": "batch", "output": [' + ", ".join(
+            message.data for message in batch) + "]}")
+
+    @staticmethod
+    def _is_batchable(message: Outbound_Message) -> bool:
+        """
+        Returns whether a control message can join a batch: a json message too short to be compressed
+
+        Args:
+            message (Outbound_Message): the message
+
+        Returns:
+            bool: whether the message can be batched
+        """
+        return not message.is_binary and len(message) < COMPRESSION_THRESHOLD
+
+    def _stop_writer(self) -> None:
+        """
+        Stops sending queued messages
+        """
+        self._control_messages.clear()
+        self._video_messages.clear()
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+
+    async def send(self, message: Outbound_Message) -> None:
+        """
+        Sends an already serialized message to the client
+
+        Large json messages are sent compressed if the client can inflate them
+
+        Args:
+            message (Outbound_Message): the message
+        """
+        if message.is_binary:
+            await self.socket.send_bytes(message.data)
+            return
+        compressed = message.compressed() if self.compression else None
+        if compressed is not None:
+            await self.socket.send_bytes(compressed)
+        else:
+            await self.socket.send_text(message.data)
 
     def set_socket(self, socket: object) -> None:
         """
@@ -119,21 +419,61 @@ class Websocket_List:
         Also handles printing
         
     Attributes:
-        sockets(dict): a dictionary of all active sockets
+        sockets(WeakValueDictionary): every open socket by its index. Holds weak references, so a socket whose
+            connection handler has ended can never be sent to, even before it is removed
+        _indexes(count): hands out the index of each new socket. Indexes are never reused, so output meant for a
+            closed socket is dropped instead of reaching the client that connected after it
         keyboard_control_socket_index(int): the index of the socket with keyboard control
         loop(AbstractEventLoop): the asyncio event loop
+        _outbox(Queue): messages from ```print``` waiting to be dispatched, created on the event loop
+        _dispatcher(Task): the task dispatching the messages in the outbox
+        state(State_Publisher): sends the state topics, ex. the battery percentage, to every socket when they change
+        _heartbeat(Task): the task pinging the sockets and reaping the ones that stopped answering
+        _reaped(int): how many sockets the heartbeat has reaped
+        _recently_reaped(deque): the index, time and silence of the most recently reaped sockets
+        _subscribers(defaultdict): the indexes of the sockets subscribed to each topic
         
     Methods:
         remove_key(key):
             Removes a socket from the list
-        _find_lowest_key():
-            Finds the lowest available number not in the list to be used for a new socket
         add_socket(socket):
-            Adds a socket to the list
+            Adds a socket to the list, starting the heartbeat the first time
+        _run_heartbeat():
+            Pings every socket once per heartbeat interval, and reaps the sockets that stopped answering
+        _reap(socket, silent_for):
+            Closes and removes a socket whose client stopped answering pings
+        get_socket_stats():
+            Returns how many sockets are open and how many were reaped by the heartbeat
         print_out(socket_index, message, all, type):
             Outputs information to the client(s)
         print(socket_index, message, all, type):
-            Takes information to be sent to ```print_out``` and creates an asynchronous task to output information
+            Takes information to be sent to ```print_out``` and hands it to the dispatcher, from any thread
+        _post(item):
+            Puts a message in the outbox, starting the dispatcher the first time
+        _dispatch():
+            Dispatches the messages in the outbox in batches, for as long as the server runs
+        _coalesce(batch):
+            Drops the messages of a batch that a newer message of the same type replaces
+        _is_on_loop():
+            Returns whether the caller is running on the event loop
+        send_out(socket_index, message, all):
+            Queues an already serialized message to be sent to the client(s)
+        publish(message, topics):
+            Queues an already serialized message for every socket subscribed to its topics
+        update_subscribers(socket_index, old_topics, new_topics):
+            Moves a socket from the subscribers of its old topics to the subscribers of its new topics
+        on_subscribed(socket, topics):
+            Sends a socket the current value of the topics it just subscribed to
+        topics_of(message):
+            Returns the topics a message is published on
+        print_message(socket_index, message, all):
+            Takes an already serialized message and queues it from the event loop
+        get_subscribed_cameras():
+            Returns every camera at least one socket subscribed to
+        get_rendition_levels():
+            Returns the video rendition levels the sockets currently want
+        get_video_stats():
+            Returns the video quality of each socket
         start_keyboard_control(socket_index):
             Allows a client to take keyboard control if another does not already have control
         release_keyboard_control(socket_index):
@@ -142,53 +482,114 @@ class Websocket_List:
             Handles keyboard controls and relays them to the background process
     """
     def __init__(self):
-        self.sockets = {}
-        # A list of queued outputs
+        self.sockets = weakref.WeakValueDictionary()
+        self._indexes = itertools.count()
         self.keyboard_control_socket_index = -1
         self.loop = asyncio.get_event_loop()
+        self._outbox = None
+        self._dispatcher = None
+        self._subscribers = collections.defaultdict(set)
+        self.state = State_Publisher(self.loop, self.publish, MESSAGE_TOPICS.get)
+        self._heartbeat = None
+        self._reaped = 0
+        self._recently_reaped = collections.deque(maxlen=REAPED_HISTORY)
 
     def remove_key(self, key: str) -> None:
         """
-        Removes a socket from the list
+        Removes a socket from the list, and releases keyboard control if the socket had it
 
         Args:
             key (str): the index of the socket to remove
         """
-        if key in self.sockets:
-            self.sockets.pop(key, None)
+        socket = self.sockets.pop(key, None)
+        if socket is not None:
+            self.update_subscribers(key, socket.topics, frozenset())
+        self.release_keyboard_control(key)
 
-    def _find_lowest_key(self) -> str:
+    def add_socket(self, socket: object) -> Websocket:
         """
-        Finds the lowest available number not in the list to be used for a new socket
+        Adds a socket to the list
+
+        The list only holds a weak reference, so the caller must keep the returned socket for as long as the
+        connection is open
+
+        Args:
+            socket (object): the socket to be added
 
         Returns:
-            str: the number, as a string
+            Websocket: the socket, its index is a connection id that is never reused
         """
-        for i in range(0, len(self.sockets) + 1):
-            if str(i) not in self.sockets:
-                return str(i)
-
-    def add_socket(self, socket: object) -> str:
+        new_socket = Websocket(socket, self, str(next(self._indexes)))
+        self.sockets[new_socket.index] = new_socket
+        new_socket._set_topics(DEFAULT_TOPICS)
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.ensure_future(self._run_heartbeat())
+        return new_socket
+
+    async def _run_heartbeat(self) -> None:
         """
-        Adds a socket to the list
+        Pings every socket once per heartbeat interval, and reaps the sockets that stopped answering
+        """
+        # Imported here because utils imports this module
+        from SpotSite.utils import read_json
+        config = read_json("SpotSite/config.json").get("websocket", {})
+        interval = float(config.get("heartbeat_interval", HEARTBEAT_INTERVAL))
+        timeout = float(config.get("heartbeat_timeout", HEARTBEAT_TIMEOUT))
+
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            ping = encode_message("ping", time.time())
+            for socket in list(self.sockets.values()):
+                if now - socket.last_seen > timeout:
+                    self._reap(socket, now - socket.last_seen)
+                else:
+                    socket.enqueue(ping)
 
+    def _reap(self, socket: Websocket, silent_for: float) -> None:
+        """
+        Closes and removes a socket whose client stopped answering pings
 
         Args:
-            socket (object): the socket to be added
+            socket (Websocket): the socket
+            silent_for (float): how long the client has not sent anything, in seconds
+        """
+        log(f"Socket {socket.index} did not answer for {silent_for:.1f} seconds, closing it")
+        was_alive = socket.alive
+        socket.alive = False
+        socket._stop_writer()
+        self.remove_key(socket.index)
+        # A socket that is no longer alive is already closed or disconnected, ex. it fell too far behind, and closing
+        # it again would raise in a task nobody awaits
+        if was_alive:
+            asyncio.ensure_future(socket.close())
+
+        self._reaped += 1
+        self._recently_reaped.append({
+            "index": socket.index,
+            "reaped_at": time.time(),
+            "silent_seconds": round(silent_for, 1),
+        })
+
+    def get_socket_stats(self) -> dict:
+        """
+        Returns how many sockets are open and how many were reaped by the heartbeat
 
         Returns:
-            str: the index of the socket, determined during the procedure
+            dict: the stats
         """
-
-        new_index = self._find_lowest_key()
-        new_socket = Websocket(socket, self, new_index)
-        self.sockets[new_index] = new_socket
-        return new_index
+        return {
+            "open": len(self.sockets),
+            "reaped": self._reaped,
+            "recently_reaped": list(self._recently_reaped),
+        }
 
     async def print_out(self, socket_index: any, message: str, all: bool = False, type: str = "output") -> None:
         """
         Outputs information to the client(s)
 
+        The message is serialized once, no matter how many clients receive it
+
         Args:
             socket_index (int, str): the index of the socket to output to (-1 can be used to denote that there are multiple sockets)
             message (str): the information to be outputted
@@ -197,37 +598,228 @@ class Websocket_List:
         """
         if socket_index == -1 and not all:
             print(message)
-            return 
-        try:
-            if all:
-                for sI in self.sockets:
-                    await self.sockets[sI].socket.send_json({
-                        "type": type,
-                        "output": message
-                    })
-            # Outputs to a single specified socket
-            else:
-                try:
-                    await self.sockets[socket_index].socket.send_json({
-                        "type": type,
-                        "output": message
-                    })
-                except KeyError:
-                    print("KEY ERORR: ", socket_index)
-                    print("MESSAGE: ", message)
-        except Exception as e:
-            if str(e) == "Unexpected ASGI message 'websocket.send', after sending 'websocket.close'.":
-                pass
-            else:
-                self.print(-1, str(message), all=True)
+            return
+        self.send_out(socket_index, encode_message(type, message), all=all)
+
+    def send_out(self, socket_index: any, message: Outbound_Message, all: bool = False) -> None:
+        """
+        Queues an already serialized message to be sent to the client(s)
+
+        Every client is handed the same message object, so nothing is serialized per client. Each socket sends its
+        own queue, so a slow client does not hold up the others
+
+        Args:
+            socket_index (int, str): the index of the socket to send to (-1 can be used to denote that there are multiple sockets)
+            message (Outbound_Message): the message
+            all (bool, optional): whether all sockets subscribed to the topic of the message should receive it.
+                Defaults to False.
+        """
+        if all:
+            self.publish(message)
+        elif socket_index in self.sockets:
+            self.sockets[socket_index].enqueue(message)
+        else:
+            print("KEY ERORR: ", socket_index)
+            print("MESSAGE TYPE: ", message.type)
+
+    def publish(self, message: Outbound_Message, topics: tuple = None) -> None:
+        """
+        Queues an already serialized message for every socket subscribed to its topics
+
+        Must be called from the event loop
+
+        Args:
+            message (Outbound_Message): the message
+            topics (tuple, optional): the topics the message is published on, None for the topics of its type (see
+                ```topics_of```). A topic of None sends the message to every socket. Defaults to None.
+        """
+        if topics is None:
+            topics = self.topics_of(message)
+        if None in topics:
+            for socket in list(self.sockets.values()):
+                socket.enqueue(message)
+            return
+
+        indexes = self._subscribers.get(topics[0], ())
+        if len(topics) > 1:
+            indexes = set(indexes).union(*(self._subscribers.get(topic, ()) for topic in topics[1:]))
+        for index in list(indexes):
+            socket = self.sockets.get(index)
+            if socket is not None:
+                socket.enqueue(message)
+
+    def update_subscribers(self, socket_index: str, old_topics: frozenset, new_topics: frozenset) -> None:
+        """
+        Moves a socket from the subscribers of its old topics to the subscribers of its new topics
+
+        Args:
+            socket_index (str): the index of the socket
+            old_topics (frozenset): the topics the socket was subscribed to
+            new_topics (frozenset): the topics the socket is subscribed to now
+        """
+        for topic in old_topics - new_topics:
+            self._subscribers[topic].discard(socket_index)
+        for topic in new_topics - old_topics:
+            self._subscribers[topic].add(socket_index)
+
+    def on_subscribed(self, socket: Websocket, topics: frozenset) -> None:
+        """
+        Sends a socket the current value of the topics it just subscribed to, so it does not wait for the next change
+
+        Args:
+            socket (Websocket): the socket
+            topics (frozenset): the topics it just subscribed to
+        """
+        state = {name: value for name, value in self.state.snapshot().items() if MESSAGE_TOPICS.get(name) in topics}
+        if state:
+            socket.enqueue(encode_message("state", state))
+        if "command_queue" in topics:
+            background_process.bg_process.send_command_queue_snapshot(socket.index)
+
+    @staticmethod
+    def topics_of(message: Outbound_Message) -> tuple:
+        """
+        Returns the topics a message is published on
+
+        A video frame is published on the topic of its camera, and a tile also on the topic of the view it is part of
+
+        Args:
+            message (Outbound_Message): the message
+
+        Returns:
+            tuple: the topics, (None,) if every socket receives the message
+        """
+        if message.is_video:
+            camera_name = message.type[1:]
+            view = message.video_view
+            if view == camera_name:
+                return (VIDEO_TOPIC_PREFIX + camera_name,)
+            return (VIDEO_TOPIC_PREFIX + camera_name, VIDEO_TOPIC_PREFIX + view)
+        return (MESSAGE_TOPICS.get(message.type),)
 
     def print(self, socket_index: any, message: str, all: bool = False, type: str = "output") -> None:
         """
-        Takes information to be sent to ```print_out``` and creates an asynchronous task to output information
+        Takes information to be sent to ```print_out``` and hands it to the dispatcher
+
+        Safe to call from any thread. From another thread the message crosses over with a single
+        ```call_soon_threadsafe```, and no task is created per message
 
         see ```print_out``` method for argument information
         """
-        asyncio.ensure_future(self.print_out(socket_index, message, all=all, type=type), loop=self.loop)
+        item = (socket_index, message, all, type)
+        if self._is_on_loop():
+            self._post(item)
+        else:
+            self.loop.call_soon_threadsafe(self._post, item)
+
+    def _post(self, item: tuple) -> None:
+        """
+        Puts a message in the outbox, starting the dispatcher the first time
+
+        Must be called from the event loop
+
+        Args:
+            item (tuple): the arguments of ```print_out```
+        """
+        if self._outbox is None:
+            self._outbox = asyncio.Queue()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        self._outbox.put_nowait(item)
+
+    async def _dispatch(self) -> None:
+        """
+        Dispatches the messages in the outbox in batches, for as long as the server runs
+
+        Every message waiting when the dispatcher wakes up is handled as one batch
+        """
+        while True:
+            batch = [await self._outbox.get()]
+            while not self._outbox.empty():
+                batch.append(self._outbox.get_nowait())
+
+            for socket_index, message, all, type in self._coalesce(batch):
+                try:
+                    await self.print_out(socket_index, message, all=all, type=type)
+                except Exception as e:
+                    log(f"Failed to dispatch {type}: {e}")
+
+    @staticmethod
+    def _coalesce(batch: list) -> list:
+        """
+        Drops the messages of a batch that a newer message of the same type, to the same sockets, replaces
+
+        Args:
+            batch (list): the arguments of ```print_out``` for each message, oldest first
+
+        Returns:
+            list: the messages left, in their original order
+        """
+        newest = {}
+        for position, (socket_index, _, all, type) in enumerate(batch):
+            if type in COALESCED_TYPES:
+                newest[(type, socket_index, all)] = position
+        return [item for position, item in enumerate(batch)
+                if item[3] not in COALESCED_TYPES or newest[(item[3], item[0], item[2])] == position]
+
+    def _is_on_loop(self) -> bool:
+        """
+        Returns whether the caller is running on the event loop
+
+        Returns:
+            bool: whether the caller is running on the event loop
+        """
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def print_message(self, socket_index: any, message: Outbound_Message, all: bool = False) -> None:
+        """
+        Takes an already serialized message and queues it from the event loop
+
+        Safe to call from any thread. On the event loop the message is queued right away
+
+        see ```send_out``` method for argument information
+        """
+        if self._is_on_loop():
+            self.send_out(socket_index, message, all)
+        else:
+            self.loop.call_soon_threadsafe(self.send_out, socket_index, message, all)
+
+    def get_subscribed_cameras(self) -> set:
+        """
+        Returns every camera at least one socket subscribed to
+
+        Safe to call from any thread
+
+        Returns:
+            set: the names of the cameras
+        """
+        cameras = set()
+        for socket in list(self.sockets.values()):
+            cameras.update(socket.cameras)
+        return cameras
+
+    def get_rendition_levels(self) -> set:
+        """
+        Returns the video rendition levels the sockets currently want, so only those are encoded
+
+        Safe to call from any thread
+
+        Returns:
+            set: the rendition levels
+        """
+        return {socket.video_rate.level for socket in list(self.sockets.values()) if socket.cameras}
+
+    def get_video_stats(self) -> dict:
+        """
+        Returns the video quality of each socket
+
+        Returns:
+            dict: the stats of each socket, by socket index
+        """
+        return {index: socket.video_rate.get_stats() for index, socket in list(self.sockets.items())}
 
     def start_keyboard_control(self, socket_index: str) -> None:
         """
@@ -272,12 +864,28 @@ class Websocket_List:
 websocket_list = Websocket_List()
 
 
+def expand_topics(topics: list) -> frozenset:
+    """
+    Replaces the "video/*" wildcard in a list of topics with the video topic of every camera
+
+    Args:
+        topics (list): the topics
+
+    Returns:
+        frozenset: the topics, without the wildcard
+    """
+    topics = frozenset(topics)
+    if VIDEO_WILDCARD_TOPIC in topics:
+        topics = (topics - {VIDEO_WILDCARD_TOPIC}) | frozenset(VIDEO_TOPIC_PREFIX + camera for camera in CAMERA_IDS)
+    return topics
+
+
 def close_all_sockets() -> None:
     """
         Closes all sockets
         Called when the server is shutting down
     """
-    for _, socket in websocket_list.sockets.items():
+    for socket in list(websocket_list.sockets.values()):
         socket.alive = False
     print("\033[92m" + "    Websockets" + "\033[0m" + ": Closing sockets")
     time.sleep(0.5)
@@ -35,6 +35,7 @@ urlpatterns = [
     path('execute-file', views.execute_file, name='execute_file'),
     path('set_scratch_controller', views.set_scratch_controller, name='set_scratch_controller'),
     path('set-robot-height', views.set_robot_height, name='set_robot_height'),
+    path('camera/<str:camera_name>.mjpg', views.camera_stream, name='camera_stream'),
     path(
         "favicon.ico",
         RedirectView.as_view(url=staticfiles_storage.url("favicon.ico")),